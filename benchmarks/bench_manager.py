@@ -0,0 +1,93 @@
+"""Home Assistant side: manager update cycles and entity updates.
+
+These need Home Assistant installed and are skipped otherwise. A minimal
+stand-in for ``hass`` is used so that only the component's own work is
+timed, not Home Assistant's state machine.
+"""
+import copy
+import tempfile
+
+from common import load_component, load_myenergi, params, status_payload
+
+myenergi = load_myenergi()
+
+
+class _Config:
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp()
+
+    def path(self, *parts):
+        return '/'.join((self.directory,) + parts)
+
+
+class _Hass:
+
+    def __init__(self):
+        self.config = _Config()
+        self.tasks = 0
+        self.writes = 0
+
+    def async_create_task(self, coro):
+        self.tasks += 1
+        coro.close()
+
+    def write_state(self):
+        self.writes += 1
+
+
+def _cycle(manager, payload):
+    devices = manager.hub._update_from_status(payload)
+    manager.update_zappis(devices[myenergi.Zappi.device_map_key])
+    manager.update_harvis(devices[myenergi.Harvi.device_map_key])
+    manager.energy_meter.add_devices(
+        devices[myenergi.Zappi.device_map_key] + devices[myenergi.Harvi.device_map_key])
+    manager.update_energy()
+
+
+def _manager(devices):
+    platform, _, _ = load_component()
+    hass = _Hass()
+    manager = platform.MyEnergiManager(hass, 'hub', 'password')
+    payload = status_payload(zappis=devices, harvis=devices, generators=3)
+    _cycle(manager, payload)
+    # Treat the entities as added, but count state writes instead of
+    # making them
+    for seen in (manager._zappis_seen, manager._harvis_seen):
+        for coordinator in seen.values():
+            for entity in coordinator.entities:
+                entity.hass = hass
+                entity.async_write_ha_state = hass.write_state
+    return manager, payload
+
+
+@params(1, 10, 50)
+def bench_manager_cycle_unchanged(devices):
+    manager, payload = _manager(devices)
+    yield lambda: _cycle(manager, payload)
+
+
+@params(1, 10, 50)
+def bench_manager_cycle_changed(devices):
+    manager, payload = _manager(devices)
+    payloads = [copy.deepcopy(payload), copy.deepcopy(payload)]
+    for section in payloads[1]:
+        for data in section.get('zappi', []) + section.get('harvi', []):
+            data['ectp1'] += 1
+    state = [0]
+
+    def cycle():
+        state[0] ^= 1
+        _cycle(manager, payloads[state[0]])
+    yield cycle
+
+
+def bench_sensor_updates():
+    manager, payload = _manager(1)
+    entities = [e for seen in (manager._zappis_seen, manager._harvis_seen)
+                for coordinator in seen.values() for e in coordinator.entities]
+
+    def update():
+        for entity in entities:
+            entity.update()
+    yield update
@@ -0,0 +1,34 @@
+"""Cost of parsing status JSON into devices."""
+from common import harvi_payload, load_myenergi, params, status_payload, zappi_payload
+
+myenergi = load_myenergi()
+
+
+def _steady_state(device_cls, payload):
+    # The usual case when polling: the hub already knows the device
+    hub = myenergi.Hub(1, 'password')
+    hub._update_devices(device_cls, [payload])
+    yield lambda: device_cls.from_json(payload, hub)
+
+
+@params(0, 1, 3, 5)
+def bench_zappi_from_json(generators):
+    yield from _steady_state(myenergi.Zappi, zappi_payload(generators=generators))
+
+
+@params(0, 1, 3, 5)
+def bench_harvi_from_json(generators):
+    yield from _steady_state(myenergi.Harvi, harvi_payload(generators=generators))
+
+
+def bench_zappi_from_json_new_device():
+    payload = zappi_payload(generators=3)
+    yield lambda: myenergi.Zappi.from_json(payload, myenergi.Hub(1, 'password'))
+
+
+@params(1, 10, 100)
+def bench_hub_status(devices):
+    hub = myenergi.Hub(1, 'password')
+    payload = status_payload(zappis=devices, harvis=devices, generators=3)
+    hub._update_from_status(payload)
+    yield lambda: hub._update_from_status(payload)
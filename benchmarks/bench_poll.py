@@ -0,0 +1,41 @@
+"""End-to-end poll latency against the local mock director."""
+import asyncio
+
+from common import load_myenergi, params
+
+myenergi = load_myenergi()
+import mock_director  # noqa: E402
+
+
+def _run_with_director(make_poll, **director_kwargs):
+    loop = asyncio.new_event_loop()
+    director = mock_director.MockDirector(seed=1, **director_kwargs)
+    loop.run_until_complete(director.async_start())
+    poll, close = make_poll(director)
+    # Warm up: ASN redirect and digest challenge
+    loop.run_until_complete(poll())
+    try:
+        yield lambda: loop.run_until_complete(poll())
+    finally:
+        loop.run_until_complete(close())
+        loop.run_until_complete(director.async_stop())
+        loop.close()
+
+
+@params(1, 10)
+def bench_hub_fetch_all(zappis):
+    def make_poll(director):
+        hub = myenergi.Hub(mock_director.FIRST_HUB_SERIAL, 'password',
+                           director=director.url)
+        return hub.async_fetch_all, hub.async_close
+    yield from _run_with_director(make_poll, zappis=zappis, harvis=zappis)
+
+
+@params(10, 100)
+def bench_fleet_poll_all(hubs):
+    def make_poll(director):
+        fleet = myenergi.Fleet(max_concurrency=10, director=director.url)
+        for serial in director.hubs:
+            fleet.add_hub(serial, 'password')
+        return fleet.async_poll_all, fleet.async_stop
+    yield from _run_with_director(make_poll, hubs=hubs)
@@ -0,0 +1,42 @@
+"""Cost of keeping rolling power statistics, which should not grow with
+the length of the window."""
+import datetime
+import itertools
+import random
+
+from common import load_myenergi, params, zappi_payload
+
+myenergi = load_myenergi()
+
+
+@params(60, 900, 86400)
+def bench_window_add(seconds):
+    window = myenergi.RollingWindow(seconds)
+    rng = random.Random(1)
+    values = [rng.uniform(-3000, 3000) for _ in range(1000)]
+    times = itertools.count()
+    # Fill the window first, so every reading also expires one
+    for _ in range(seconds):
+        window.add(next(times), rng.choice(values))
+    samples = itertools.cycle(values)
+    yield lambda: window.add(next(times), next(samples))
+
+
+def bench_zappi_from_json_rolling():
+    rolling_metrics = myenergi.RollingMetrics()
+    hub = myenergi.Hub(1, 'password', rolling_metrics=rolling_metrics)
+    payload = zappi_payload(generators=3)
+    hub._update_devices(myenergi.Zappi, [payload])
+    # Every poll is 10 seconds on from the last, so makes a new sample
+    # and the windows stay full rather than growing
+    polls = itertools.count(1)
+    start = datetime.datetime(2026, 10, 18)
+
+    def poll():
+        now = start + datetime.timedelta(seconds=10 * next(polls))
+        payload['dat'] = now.strftime('%d-%m-%Y')
+        payload['tim'] = now.strftime('%H:%M:%S')
+        myenergi.Zappi.from_json(payload, hub)
+        # As reading any of the statistics would after each poll
+        rolling_metrics.flush()
+    yield poll
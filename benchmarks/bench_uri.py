@@ -0,0 +1,14 @@
+"""Cost of building request URIs."""
+from common import load_myenergi
+
+myenergi = load_myenergi()
+
+
+def bench_get_uri_status():
+    yield lambda: myenergi.get_uri('jstatus', {'id': '*'}, asn='s18.myenergi.net')
+
+
+def bench_get_uri_zappi_mode():
+    params = {'id': 'Z12345678', 'mode': 1, 'boost': 0, 'kwh': 0, 'targetTime': '0000'}
+    order = ['id', 'mode', 'boost', 'kwh', 'targetTime']
+    yield lambda: myenergi.get_uri('zappi-mode', params, order, asn='s18.myenergi.net')
@@ -0,0 +1,99 @@
+"""Shared helpers for the benchmarks.
+
+myenergi.py is loaded by tools/_loader.py, which explains why.
+"""
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
+
+import _loader  # noqa: E402
+from _loader import ROOT  # noqa: E402
+
+COMPONENT = 'myenergi_component'
+
+
+class SkipBenchmark(Exception):
+    """Raised by a benchmark that can't run here, e.g. a missing optional
+    dependency."""
+
+
+def params(*values):
+    """Run a benchmark once for each value, passed as its argument."""
+    def decorator(fn):
+        fn.params = values
+        return fn
+    return decorator
+
+
+def _quiet_logging():
+    # myenergi turns on debug logging for everything at import
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def load_myenergi():
+    loaded = 'myenergi' in sys.modules
+    module = _loader.load_myenergi()
+    if not loaded:
+        _quiet_logging()
+    return module
+
+
+def load_component():
+    """Import the Home Assistant component as a package, returning its
+    platform, sensor and binary_sensor modules. Needs Home Assistant."""
+    if COMPONENT not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            COMPONENT, os.path.join(ROOT, '__init__.py'),
+            submodule_search_locations=[ROOT])
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[COMPONENT] = package
+        spec.loader.exec_module(package)
+        _quiet_logging()
+    try:
+        return tuple(
+            importlib.import_module('{}.{}'.format(COMPONENT, name))
+            for name in ('platform', 'sensor', 'binary_sensor'))
+    except ImportError as e:
+        raise SkipBenchmark('Home Assistant is not installed ({})'.format(e))
+
+
+GENERATOR_TYPES = ['Grid', 'Solar', 'Battery', 'Internal Load', 'None']
+
+
+def generator_fields(count):
+    data = {}
+    for n in range(1, 6):
+        data['ectt{}'.format(n)] = GENERATOR_TYPES[n - 1] if n <= count else 'None'
+        data['ectp{}'.format(n)] = 100 * n if n <= count else 0
+    return data
+
+
+def zappi_payload(serial=12345678, generators=2):
+    data = {
+        'sno': serial, 'dat': '18-10-2026', 'tim': '10:11:12',
+        'frq': 50.01, 'pha': 1, 'sta': 3, 'pst': 'C2', 'vol': 2405,
+        'div': 1500, 'pri': 1, 'cmt': 254, 'zmo': 2, 'tbk': 0, 'sbk': 0,
+        'che': 3.2, 'mgl': 50, 'sbh': 7, 'sbm': 30,
+    }
+    data.update(generator_fields(generators))
+    return data
+
+
+def harvi_payload(serial=87654321, generators=2):
+    data = {'sno': serial, 'dat': '18-10-2026', 'tim': '10:11:12'}
+    data.update(generator_fields(generators))
+    return data
+
+
+def status_payload(zappis=1, harvis=1, generators=2):
+    """An unfiltered jstatus response for one hub."""
+    return [
+        {'eddi': []},
+        {'zappi': [zappi_payload(10000000 + n, generators) for n in range(zappis)]},
+        {'harvi': [harvi_payload(20000000 + n, generators) for n in range(harvis)]},
+        {'asn': 's18.myenergi.net', 'fwv': '3401S3.077'},
+    ]
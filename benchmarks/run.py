@@ -0,0 +1,188 @@
+"""Runs the benchmarks and compares them with the stored baseline.
+
+    python benchmarks/run.py               # everything, compared with baseline.json
+    python benchmarks/run.py parse uri     # just bench_parse.py and bench_uri.py
+    python benchmarks/run.py --save        # store the results as the new baseline
+
+Each ``bench_*`` function in a ``bench_*.py`` module is a generator that
+does its setup, yields the callable to time, then tears down. Results are
+the median time per call over ``--repeat`` short runs. The run fails if
+anything is slower than its baseline by more than ``--threshold``, or by
+more than twice the spread (interquartile range) of its own runs if that
+is wider.
+
+Timings also shift between processes, e.g. with memory layout, by more
+than within one. So a benchmark that looks slower is measured again in
+up to ``--confirm`` fresh processes and only reported if it stays
+slower, and ``--save`` stores the median over that many processes plus
+this one.
+
+Baselines are only comparable on the machine that recorded them, so
+re-save after changing machines.
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+from common import SkipBenchmark
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+
+def discover(names):
+    for path in sorted(glob.glob(os.path.join(HERE, 'bench_*.py'))):
+        module_name = os.path.basename(path)[:-3]
+        if names and module_name[len('bench_'):] not in names:
+            continue
+        module = importlib.import_module(module_name)
+        for attr in sorted(dir(module)):
+            fn = getattr(module, attr)
+            if not attr.startswith('bench_') or not callable(fn):
+                continue
+            label = '{}.{}'.format(module_name[len('bench_'):], attr[len('bench_'):])
+            for param in getattr(fn, 'params', [None]):
+                if param is None:
+                    yield label, fn, ()
+                else:
+                    yield '{}[{}]'.format(label, param), fn, (param,)
+
+
+# Seconds per run; many short runs give a better median than a few long ones
+RUN_TIME = 0.05
+
+
+def calibrate(timer):
+    number = 1
+    while True:
+        if timer.timeit(number) >= RUN_TIME:
+            return number
+        number *= 2
+
+
+def measure(fn, args, repeat):
+    """Return the median seconds per call, and the interquartile range of
+    the runs relative to it."""
+    bench = fn(*args)
+    try:
+        target = next(bench)
+        timer = timeit.Timer(target)
+        number = calibrate(timer)
+        times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    finally:
+        bench.close()
+    median = statistics.median(times)
+    if len(times) < 4:
+        return median, 0.0
+    q1, _, q3 = statistics.quantiles(times, n=4)
+    return median, (q3 - q1) / median
+
+
+def measure_in_subprocess(label, repeat):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--measure', label,
+        '--repeat', str(repeat)])
+    return tuple(json.loads(output.decode().splitlines()[-1]))
+
+
+def measure_one(label, repeat):
+    """Print the result of one benchmark as JSON, for measure_in_subprocess."""
+    for found, fn, fn_args in discover([label.split('.')[0]]):
+        if found == label:
+            print(json.dumps(measure(fn, fn_args, repeat)))
+            return 0
+    print('No benchmark {}'.format(label), file=sys.stderr)
+    return 1
+
+
+def regressed(ratio, spread, threshold):
+    return ratio > 1 + max(threshold, 2 * spread)
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:8.2f} {}'.format(seconds / scale, unit)
+    return '{:8.2f} ns'.format(seconds / 1e-9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the pymyenergi benchmarks.')
+    parser.add_argument('names', nargs='*',
+                        help='modules to run, e.g. "parse" for bench_parse.py')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown before failing (default 0.25)')
+    parser.add_argument('--repeat', type=int, default=21,
+                        help='runs per measurement (default 21)')
+    parser.add_argument('--confirm', type=int, default=2,
+                        help='fresh processes to re-measure apparent '
+                             'regressions, or to save the median of, in '
+                             '(default 2)')
+    parser.add_argument('--measure', metavar='LABEL', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.measure:
+        return measure_one(args.measure, args.repeat)
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f).get('results', {})
+
+    results = {}
+    regressions = []
+    for label, fn, fn_args in discover(args.names):
+        try:
+            seconds, spread = measure(fn, fn_args, args.repeat)
+        except SkipBenchmark as e:
+            print('{:<45} skipped: {}'.format(label, e))
+            continue
+        if args.save:
+            runs = [seconds] + [measure_in_subprocess(label, args.repeat)[0]
+                                for _ in range(args.confirm)]
+            seconds = statistics.median(runs)
+        else:
+            for _ in range(args.confirm):
+                if label not in baseline or not regressed(
+                        seconds / baseline[label], spread, args.threshold):
+                    break
+                seconds, spread = min((seconds, spread),
+                                      measure_in_subprocess(label, args.repeat))
+        results[label] = seconds
+        line = '{:<45} {} ±{:3.0%}'.format(label, format_time(seconds), spread)
+        if label in baseline:
+            ratio = seconds / baseline[label]
+            line += '   {:5.2f}x baseline'.format(ratio)
+            if regressed(ratio, spread, args.threshold):
+                line += '  REGRESSION'
+                regressions.append(label)
+        print(line, flush=True)
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump({
+                'machine': platform.platform(),
+                'python': platform.python_version(),
+                'results': baseline,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved {} results to {}'.format(len(results), BASELINE))
+    elif regressions:
+        print('{} benchmark(s) regressed by more than {:.0%}'.format(
+            len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,9 +23,11 @@ async def async_setup_platform(hass, config, async_add_entities, device_config=N
 class ZappiPresenceSensor(BinarySensorEntity):
     """The entity class for the Zappi charging station presence sensor."""
 
-    def __init__(self, zappi):
+    source_fields = ('status',)
+
+    def __init__(self, coordinator):
         """Initialize the Zappi Sensor."""
-        self._device = zappi
+        self._device = coordinator.device
         self._name = 'Zappi z{} car connected'.format(self._device.serial)
         self._icon = 'mdi:car'
         self._state = None
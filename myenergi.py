@@ -1,25 +1,60 @@
+import argparse
+import array
 import asyncio
+import bisect
+import calendar
+import codecs
+import collections
+import csv
 import datetime
 import enum
+import hashlib
+import io
+import json
 import logging
 import math
+import mmap
+import os
+import random
+import stat
+import struct
 import sys
+import tempfile
+import time
 from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.request import parse_http_list, parse_keqv_list
 import weakref
 
+import aiohttp
 import pytz
 import requests
-from requests.auth import HTTPDigestAuth
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 logger = logging.getLogger(__name__)
 api_host_default = "director.myenergi.net"
+request_headers = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+}
 
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Accepts the raw response bytes
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 
-def get_uri(m, params=None, order=None, sep=None, asn=None):
+def get_uri(m, params=None, order=None, sep=None, asn=None, scheme="https"):
     if params is None:
         params = {}
     if order is None:
@@ -29,10 +64,10 @@ def get_uri(m, params=None, order=None, sep=None, asn=None):
     if not asn:
         asn = api_host_default
 
-    qs = "-" + sep.join([params[k] for k in order])
+    qs = "-" + sep.join([str(params[k]) for k in order])
     return urlunparse(
         (
-            "https",
+            scheme,
             asn,
             "/cgi-{}{}".format(m, qs),
             "",
@@ -42,57 +77,1229 @@ def get_uri(m, params=None, order=None, sep=None, asn=None):
     )
 
 
+def _md5(data):
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+def _sha256(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+_digest_algorithms = {
+    'MD5': _md5,
+    'MD5-SESS': _md5,
+    'SHA-256': _sha256,
+    'SHA-256-SESS': _sha256,
+}
+
+
+class DigestAuth:
+    """HTTP Digest authentication state for one set of credentials.
+
+    The last challenge from the server is kept so that it can be answered
+    straight away on later requests, bumping the nonce count each time.
+    """
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.realm = None
+        self.nonce = None
+        self.opaque = None
+        self.qop = None
+        self.algorithm = 'MD5'
+        self.nonce_count = 0
+        # Set when the challenge came from a cache rather than the server,
+        # in which case the server may legitimately reject it once.
+        self._restored = False
+
+    def as_dict(self):
+        return {
+            'realm': self.realm,
+            'nonce': self.nonce,
+            'opaque': self.opaque,
+            'qop': self.qop,
+            'algorithm': self.algorithm,
+            'nonce_count': self.nonce_count,
+        }
+
+    def restore(self, data):
+        if not data or data.get('algorithm') not in _digest_algorithms:
+            return
+        self.realm = data.get('realm')
+        self.nonce = data.get('nonce')
+        self.opaque = data.get('opaque')
+        self.qop = data.get('qop')
+        self.algorithm = data['algorithm']
+        self.nonce_count = data.get('nonce_count', 0)
+        self._restored = self.nonce is not None
+
+    def handle_challenge(self, header):
+        """Store the parameters of a ``WWW-Authenticate`` header.
+
+        Returns False if the header is not a usable digest challenge, or if
+        it just repeats the nonce we already answered (i.e. the credentials
+        are wrong and retrying won't help).
+        """
+        scheme, _, params = (header or '').partition(' ')
+        if scheme.lower() != 'digest':
+            return False
+        challenge = parse_keqv_list(parse_http_list(params))
+        algorithm = challenge.get('algorithm', 'MD5').upper()
+        if 'nonce' not in challenge or algorithm not in _digest_algorithms:
+            return False
+        stale = challenge.get('stale', '').lower() == 'true'
+        if challenge['nonce'] == self.nonce and not (stale or self._restored):
+            return False
+        self._restored = False
+        self.realm = challenge.get('realm', '')
+        self.nonce = challenge['nonce']
+        self.opaque = challenge.get('opaque')
+        self.algorithm = algorithm
+        qop = [q.strip() for q in challenge.get('qop', '').split(',')]
+        self.qop = 'auth' if 'auth' in qop else None
+        self.nonce_count = 0
+        return True
+
+    def authorization(self, method, path):
+        """Return an ``Authorization`` header value, or None if no challenge
+        has been seen yet."""
+        if self.nonce is None:
+            return None
+        hash_fn = _digest_algorithms[self.algorithm]
+        self.nonce_count += 1
+        nc = '{:08x}'.format(self.nonce_count)
+        cnonce = os.urandom(8).hex()
+        ha1 = hash_fn('{}:{}:{}'.format(self.username, self.realm, self.password))
+        if self.algorithm.endswith('-SESS'):
+            ha1 = hash_fn('{}:{}:{}'.format(ha1, self.nonce, cnonce))
+        ha2 = hash_fn('{}:{}'.format(method, path))
+        if self.qop:
+            response = hash_fn('{}:{}:{}:{}:{}:{}'.format(
+                ha1, self.nonce, nc, cnonce, self.qop, ha2))
+        else:
+            response = hash_fn('{}:{}:{}'.format(ha1, self.nonce, ha2))
+
+        fields = [
+            ('username', self.username),
+            ('realm', self.realm),
+            ('nonce', self.nonce),
+            ('uri', path),
+            ('response', response),
+        ]
+        if self.opaque is not None:
+            fields.append(('opaque', self.opaque))
+        header = ', '.join('{}="{}"'.format(k, v) for k, v in fields)
+        header += ', algorithm={}'.format(self.algorithm)
+        if self.qop:
+            header += ', qop={}, nc={}, cnonce="{}"'.format(self.qop, nc, cnonce)
+        return 'Digest ' + header
+
+
+class JsonFile:
+    """A JSON document on disk, replaced atomically on save. Read and
+    write errors are logged rather than raised; a missing or unreadable
+    file loads as ``None``."""
+
+    def __init__(self, path, description='file'):
+        self.path = path
+        self.description = description
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable %s %s: %s', self.description, self.path, e)
+        return None
+
+    def save(self, data):
+        # A temporary file of its own, so that saves from different
+        # threads can't write into each other's
+        directory, name = os.path.split(self.path)
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='{}.'.format(name), suffix='.tmp', dir=directory or '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning('Unable to write %s %s: %s', self.description, self.path, e)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+class AuthCache:
+    """Remembers the ASN and last digest challenge for each hub serial.
+
+    With a path the cache is also kept in a JSON file, so that after a
+    restart a hub goes straight to its ASN with a pre-emptive
+    ``Authorization`` header instead of rediscovering both. Inside an
+    event loop, changes are written ``save_delay`` seconds later from the
+    default executor, so as not to block the loop, one write at a time.
+    Call ``async_save()`` (or ``save()`` outside the loop) to write them
+    straight away, e.g. at shutdown.
+    """
+
+    # Challenges come in bursts, e.g. from every hub as a fleet starts
+    save_delay = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self._file = JsonFile(path, 'auth cache') if path is not None else None
+        self._entries = {}
+        self._save_handle = None
+        # The executor job of the delayed write in progress, if any
+        self._saving = None
+        if self._file is not None:
+            self._entries = self._file.load() or {}
+
+    def get(self, serial):
+        return self._entries.get(str(serial))
+
+    def set(self, serial, entry):
+        self._entries[str(serial)] = entry
+        if self._file is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop to block
+            self.save()
+            return
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(
+                self.save_delay, self._save_in_executor, loop)
+
+    def _save_in_executor(self, loop):
+        if self._saving is not None and not self._saving.done():
+            # Wait for the last write, so an older one can't land after
+            self._save_handle = loop.call_later(
+                self.save_delay, self._save_in_executor, loop)
+            return
+        self._save_handle = None
+        self._saving = loop.run_in_executor(None, self._file.save, dict(self._entries))
+
+    def _cancel_delayed_save(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+
+    def save(self):
+        """Write any changes to the file now. Not for use inside the event
+        loop; see ``async_save()``."""
+        self._cancel_delayed_save()
+        if self._file is not None:
+            self._file.save(dict(self._entries))
+
+    async def async_save(self):
+        """Write any changes to the file now, from the default executor,
+        after any delayed write already in progress."""
+        self._cancel_delayed_save()
+        if self._file is None:
+            return
+        if self._saving is not None:
+            await asyncio.gather(self._saving, return_exceptions=True)
+        self._saving = asyncio.get_running_loop().run_in_executor(
+            None, self._file.save, dict(self._entries))
+        await self._saving
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request while the circuit is open."""
+
+    def __init__(self, host, retry_after):
+        super().__init__(
+            'Requests to {} suspended for another {:.1f} seconds'.format(
+                host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops requests to a host that keeps failing.
+
+    After ``failure_threshold`` consecutive failures the circuit opens for
+    an exponentially growing, jittered delay capped at ``max_delay``. Once
+    that has passed, one request is let through (half-open): success
+    closes the circuit again, failure re-opens it for longer. With
+    ``failure_threshold`` None the circuit never opens, e.g. when
+    replaying a recording, which already lacks the requests the breaker
+    held back when it was made.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, host=None, failure_threshold=1, base_delay=10,
+                 max_delay=600):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = self.CLOSED
+        self.failures = 0
+        self._open_until = 0
+        self._probing = False
+
+    @property
+    def retry_after(self):
+        """Seconds until a request will be allowed through."""
+        if self.state == self.CLOSED:
+            return 0
+        return max(0, self._open_until - time.monotonic())
+
+    def allow_request(self):
+        if self.state == self.OPEN and time.monotonic() >= self._open_until:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            # Only one probe request at a time
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+        return self.state == self.CLOSED
+
+    def check(self):
+        """Raise CircuitOpenError if a request should not be made now."""
+        if not self.allow_request():
+            raise CircuitOpenError(self.host, self.retry_after)
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info('Requests to %s are working again', self.host)
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failure_threshold is None:
+            return
+        if self.state != self.HALF_OPEN and self.failures < self.failure_threshold:
+            return
+        exponent = self.failures - self.failure_threshold
+        cap = min(self.max_delay, self.base_delay * (2 ** min(exponent, 32)))
+        # "Equal jitter": at least half the capped delay, so hubs sharing
+        # an outage spread out without retrying almost immediately
+        delay = cap / 2 + random.uniform(0, cap / 2)
+        self.state = self.OPEN
+        self._open_until = time.monotonic() + delay
+        logger.warning('Suspending requests to %s for %.1f seconds after %s failures',
+                       self.host, delay, self.failures)
+
+
+class RequestStats:
+    """Counts how many async requests were answered without a new HTTP
+    round trip, and how many were cut short."""
+
+    def __init__(self):
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        # Requests that hit the connect or read deadline
+        self.timeouts = 0
+        # Requests cancelled because every caller stopped waiting
+        self.abandoned = 0
+
+    @property
+    def sent(self):
+        return self.requests - self.cache_hits - self.coalesced
+
+    @property
+    def hit_rate(self):
+        """Fraction of requests served from the cache or an in-flight
+        request."""
+        if not self.requests:
+            return 0.0
+        return (self.cache_hits + self.coalesced) / self.requests
+
+
+class MetricsSink:
+    """Receives measurements from a Hub. This one throws them away;
+    subclass it to forward them elsewhere, or use Metrics.
+
+    Labels are passed as keyword arguments. Measurements are names in
+    ``metric_descriptions``.
+    """
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def set_gauge(self, name, value, **labels):
+        pass
+
+
+# Name: (type, help text). Anything not listed is exported as untyped.
+metric_descriptions = {
+    'myenergi_http_request_seconds': (
+        'histogram', 'Time for one HTTP attempt, including reading the body'),
+    'myenergi_http_responses_total': ('counter', 'HTTP responses by status'),
+    'myenergi_http_response_bytes_total': ('counter', 'Response body bytes received'),
+    'myenergi_request_errors_total': (
+        'counter', 'Requests that failed without a response, by error'),
+    'myenergi_challenges_total': ('counter', 'Digest challenges received'),
+    'myenergi_redirects_total': ('counter', 'ASN redirects received'),
+    'myenergi_decode_seconds': ('histogram', 'Time spent decoding response bodies'),
+    'myenergi_parse_seconds': ('histogram', 'Time to update one device from JSON'),
+    'myenergi_poll_seconds': ('histogram', 'Time for a whole poll of a hub'),
+    'myenergi_poll_delay_seconds': ('gauge', 'Seconds until the next poll'),
+    'myenergi_circuit_open': ('gauge', '1 while requests to a host are suspended'),
+    'myenergi_circuit_failures': ('gauge', 'Consecutive failed requests to a host'),
+}
+
+
+class Histogram:
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+
+    def cumulative(self):
+        """(upper bound, count) pairs in Prometheus' cumulative form."""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+        yield math.inf, self.count
+
+
+class Metrics(MetricsSink):
+    """Keeps counters, gauges and histograms in memory for exporting with
+    ``to_prometheus()``."""
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    # Parsing is measured in microseconds, so needs finer buckets
+    buckets = {
+        'myenergi_parse_seconds': (
+            0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.01),
+        'myenergi_decode_seconds': (
+            0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1),
+    }
+
+    def __init__(self):
+        # {name: {sorted label items: value}}
+        self.counters = collections.defaultdict(dict)
+        self.gauges = collections.defaultdict(dict)
+        self.histograms = collections.defaultdict(dict)
+
+    def increment(self, name, value=1, **labels):
+        series = self.counters[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        series = self.histograms[name]
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(
+                self.buckets.get(name, self.default_buckets))
+        histogram.observe(value)
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges[name][tuple(sorted(labels.items()))] = value
+
+    def to_prometheus(self):
+        """Everything recorded so far in the Prometheus text format."""
+        lines = []
+        for kind, metrics in (('counter', self.counters), ('gauge', self.gauges),
+                              ('histogram', self.histograms)):
+            for name in sorted(metrics):
+                _, description = metric_descriptions.get(name, (kind, None))
+                if description:
+                    lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, value in sorted(metrics[name].items()):
+                    if kind != 'histogram':
+                        lines.append(_prometheus_sample(name, labels, value))
+                        continue
+                    for bound, count in value.cumulative():
+                        lines.append(_prometheus_sample(
+                            name + '_bucket', labels + (('le', bound),), count))
+                    lines.append(_prometheus_sample(name + '_sum', labels, value.sum))
+                    lines.append(_prometheus_sample(name + '_count', labels, value.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _prometheus_sample(name, labels, value):
+    if not labels:
+        return '{} {}'.format(name, _prometheus_value(value))
+    return '{}{{{}}} {}'.format(name, ','.join(
+        '{}="{}"'.format(k, str(_prometheus_value(v) if k == 'le' else v)
+                         .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels
+    ), _prometheus_value(value))
+
+
+def _request_path(uri):
+    parsed = urlparse(uri)
+    if parsed.query:
+        return '{}?{}'.format(parsed.path, parsed.query)
+    return parsed.path
+
+
+class Call(collections.namedtuple('Call', ['m', 'params', 'order', 'sep'],
+                                  defaults=(None, None))):
+    """One API call, before it is addressed to a host."""
+
+    __slots__ = ()
+
+
+def status_call(device='*'):
+    """The status of one device (e.g. ``Z12345678``), every device of one
+    type (``Z``, ``H`` or ``E``) or everything (``*``)."""
+    return Call('jstatus', {'id': str(device)})
+
+
+def set_mode_call(zappi, mode=None, boost=None, kwh=0, target_time=None):
+    if mode is None:
+        mode = ZappiMode.NO_CHANGE
+    if boost is None:
+        boost = ZappiBoostMode.NO_CHANGE
+    if target_time is None:
+        target_time = '0000'
+    return Call(
+        'zappi-mode',
+        {
+            'id': str(zappi),
+            'mode': mode.value,
+            'boost': boost.value,
+            'kwh': kwh,
+            'targetTime': target_time
+        },
+        ['id', 'mode', 'boost', 'kwh', 'targetTime']
+    )
+
+
+def merge_set_mode_calls(earlier, later):
+    """A zappi-mode call making the changes of both, ``later`` winning
+    where both change the same thing."""
+    params = dict(later.params)
+    if params['mode'] == ZappiMode.NO_CHANGE.value:
+        params['mode'] = earlier.params['mode']
+    if params['boost'] == ZappiBoostMode.NO_CHANGE.value:
+        for key in ('boost', 'kwh', 'targetTime'):
+            params[key] = earlier.params[key]
+    return later._replace(params=params)
+
+
+def boost_times_call(zappi):
+    return Call('boost-time', {'id': str(zappi)})
+
+
+def history_call(device, day, hourly=False):
+    return Call('jdayhour' if hourly else 'jday',
+                {'id': str(device), 'date': day.isoformat()}, ['id', 'date'])
+
+
+def status_items(response):
+    """Device statuses from a decoded status response, by device type.
+
+    The unfiltered status is a list of single-key objects, one per device
+    type, e.g. ``[{"eddi": [...]}, {"zappi": [...]}, ...]``; a filtered one
+    is a single such object.
+    """
+    if isinstance(response, dict):
+        response = [response]
+    items = {}
+    for section in response:
+        for key, value in section.items():
+            if isinstance(value, list):
+                items.setdefault(key, []).extend(value)
+    return items
+
+
+class Request(collections.namedtuple('Request', ['call', 'host', 'url', 'headers'])):
+    """An HTTP GET for a transport to send."""
+
+    __slots__ = ()
+
+
+class Response(collections.namedtuple('Response', ['status', 'headers', 'body', 'length'])):
+    """What a transport got back. ``body`` is None if it was fed to a
+    parser instead; ``length`` is the body size either way."""
+
+    __slots__ = ()
+
+
+class ResponseError(Exception):
+    """Raised for an error status that retrying won't fix."""
+
+    def __init__(self, request, status):
+        super().__init__('{} {} from {}'.format(status, request.call.m, request.host))
+        self.request = request
+        self.status = status
+
+
+class DecodeError(ValueError):
+    """Raised when a response body can't be decoded."""
+
+
+class HubProtocol:
+    """The director protocol, without any I/O of its own.
+
+    Addresses calls to the hub's ASN with an ``Authorization`` header, and
+    for each response decides whether to retry (after an ASN redirect or a
+    new digest challenge), fail, or decode it. Sending is up to a
+    transport, so the same logic drives sync and async clients.
+    """
+
+    # Attempts per request to cover the ASN redirect plus a digest
+    # challenge from both the director and the ASN host
+    max_request_attempts = 4
+
+    def __init__(self, serial, password, director=None, auth_cache=None,
+                 metrics=None):
+        self.serial = serial
+        # Base URL of the director, e.g. to point at a local stand-in
+        director = urlparse(director or 'https://{}'.format(api_host_default))
+        self.scheme = director.scheme
+        self.director_host = director.netloc
+        self.asn = None
+        self.auth_cache = auth_cache
+        self.metrics = metrics
+        self.digest_auth = DigestAuth(str(serial), password)
+
+        cached = auth_cache.get(serial) if auth_cache is not None else None
+        if cached:
+            self.asn = cached.get('asn')
+            self.digest_auth.restore(cached.get('digest'))
+
+    @property
+    def host(self):
+        """The host requests currently go to."""
+        return self.asn or self.director_host
+
+    def request(self, call):
+        host = self.host
+        uri = get_uri(call.m, call.params, call.order, call.sep, asn=host,
+                      scheme=self.scheme)
+        authorization = self.digest_auth.authorization('GET', _request_path(uri))
+        headers = {'Authorization': authorization} if authorization else {}
+        return Request(call, host, uri, headers)
+
+    def receive(self, request, response, attempt=0):
+        """Return True if the call should be made again with a new
+        ``request()``, False if the response is ready for ``decode()``.
+
+        Raises ResponseError for any other error status.
+        """
+        if (response.status == 401
+                and attempt + 1 < self.max_request_attempts
+                and self._handle_unauthorized(request, response.headers)):
+            return True
+        if response.status >= 400:
+            raise ResponseError(request, response.status)
+        return False
+
+    def decode(self, response, parser=None):
+        try:
+            if parser is not None:
+                return parser.close()
+            return _json_loads(response.body)
+        except DecodeError:
+            raise
+        except ValueError as e:
+            raise DecodeError('Invalid {} response body: {}'.format(
+                response.status, e)) from e
+
+    def _handle_unauthorized(self, request, headers):
+        """Pick up an ASN redirect and/or new digest challenge from a 401.
+
+        Returns True if the request is worth retrying.
+        """
+        asn = headers.get('x_myenergi-asn')
+        challenged = self.digest_auth.handle_challenge(
+            headers.get('WWW-Authenticate'))
+        redirected = bool(asn) and asn != self.asn
+        if self.metrics is not None:
+            if challenged:
+                self.metrics.increment('myenergi_challenges_total', host=request.host)
+            if redirected:
+                self.metrics.increment('myenergi_redirects_total', host=request.host)
+        if redirected:
+            logger.debug('Redirected to ASN %s', asn)
+            self.asn = asn
+        if (redirected or challenged) and self.auth_cache is not None:
+            self.auth_cache.set(self.serial, {
+                'asn': self.asn,
+                'digest': self.digest_auth.as_dict(),
+            })
+        return redirected or challenged
+
+
+class HttpTransport:
+    """Sends a hub's requests over HTTP, with aiohttp when async and
+    requests when not, using the hub's sessions and deadlines."""
+
+    async def async_send(self, hub, request, parser=None):
+        """Send ``request``. A successful body is fed to ``parser``, if
+        given, as it arrives."""
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=hub.connect_timeout, sock_read=hub.read_timeout)
+        async with hub._get_client_session().get(
+                request.url, headers=request.headers, timeout=timeout) as resp:
+            if parser is None or resp.status >= 300:
+                body = await resp.read()
+                return Response(resp.status, resp.headers, body, len(body))
+            length = 0
+            async for chunk in resp.content.iter_chunked(hub.stream_chunk_size):
+                length += len(chunk)
+                parser.feed(chunk)
+            return Response(resp.status, resp.headers, None, length)
+
+    def send(self, hub, request):
+        resp = hub.session.get(request.url, headers=request.headers,
+                               timeout=(hub.connect_timeout, hub.read_timeout))
+        return Response(resp.status_code, resp.headers, resp.content,
+                        len(resp.content))
+
+
+class RecordingTransport:
+    """Passes requests on to another transport, appending every response
+    to a file as it arrives, for ReplayTransport.
+
+    Each line of the file is a JSON object with the time, hub serial,
+    request path, status, the headers the protocol uses and the body, so
+    one file can hold a whole fleet. Requests that get no response, e.g.
+    timeouts, are not recorded.
+    """
+
+    recorded_headers = ('x_myenergi-asn', 'www-authenticate')
+
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport if transport is not None else HttpTransport()
+        self._file = open(path, 'a', encoding='ascii')
+
+    async def async_send(self, hub, request, parser=None):
+        chunks = []
+        if parser is not None:
+            parser = _TeeParser(parser, chunks)
+        response = await self.transport.async_send(hub, request, parser)
+        self._record(hub, request, response, chunks)
+        return response
+
+    def send(self, hub, request):
+        response = self.transport.send(hub, request)
+        self._record(hub, request, response, ())
+        return response
+
+    def _record(self, hub, request, response, chunks):
+        body = response.body if response.body is not None else b''.join(chunks)
+        headers = {}
+        for name in self.recorded_headers:
+            value = response.headers.get(name)
+            if value is not None:
+                headers[name] = value
+        self._file.write(json.dumps({
+            't': round(time.time(), 3),
+            'hub': str(hub.serial),
+            'path': _request_path(request.url),
+            'status': response.status,
+            'headers': headers,
+            # latin-1 maps bytes to code points one to one
+            'body': body.decode('latin-1'),
+        }, separators=(',', ':')))
+        self._file.write('\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _TeeParser:
+    """Keeps a copy of the chunks fed to a streaming parser."""
+
+    __slots__ = ('parser', 'chunks')
+
+    def __init__(self, parser, chunks):
+        self.parser = parser
+        self.chunks = chunks
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.parser.feed(data)
+
+
+class ReplayFinished(Exception):
+    """Raised by ReplayTransport when a request has no recorded responses
+    left."""
+
+
+class ReplayTransport:
+    """Answers requests from a file written by RecordingTransport,
+    without any network access.
+
+    Each request gets the next unused response recorded for the same hub
+    and path, whichever host it is sent to; recordings from before hubs
+    were recorded are matched on path alone. ``serials`` lists the hubs
+    in the recording. With ``speed`` set, responses are held
+    back until their recorded time, with time running ``speed`` times
+    faster than it did when recording (e.g. 1000); without it they are
+    returned immediately.
+    """
+
+    def __init__(self, path, speed=None):
+        self.path = path
+        self.speed = speed
+        self._responses = {}
+        self._first_time = None
+        self._started = None
+        with open(path, encoding='ascii') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if self._first_time is None:
+                    self._first_time = record['t']
+                key = (record.get('hub'), record['path'])
+                self._responses.setdefault(key, collections.deque()).append(record)
+
+    @property
+    def serials(self):
+        """The serials of the hubs in the recording, in order."""
+        return sorted({hub for hub, _ in self._responses if hub is not None})
+
+    def __len__(self):
+        """The number of responses not yet replayed."""
+        return sum(map(len, self._responses.values()))
+
+    def _next(self, hub, request):
+        path = _request_path(request.url)
+        responses = self._responses.get((str(hub.serial), path))
+        if responses is None:
+            responses = self._responses.get((None, path))
+        if not responses:
+            raise ReplayFinished('No more recorded responses for {} {}'.format(
+                hub, path))
+        return responses.popleft()
+
+    def _delay(self, record):
+        if not self.speed:
+            return 0
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        due = self._started + (record['t'] - self._first_time) / self.speed
+        return max(0, due - now)
+
+    def _response(self, record, parser):
+        body = record['body'].encode('latin-1')
+        headers = requests.structures.CaseInsensitiveDict(record['headers'])
+        if parser is not None and record['status'] < 300:
+            parser.feed(body)
+            return Response(record['status'], headers, None, len(body))
+        return Response(record['status'], headers, body, len(body))
+
+    async def async_send(self, hub, request, parser=None):
+        record = self._next(hub, request)
+        delay = self._delay(record)
+        if delay:
+            await asyncio.sleep(delay)
+        return self._response(record, parser)
+
+    def send(self, hub, request):
+        record = self._next(hub, request)
+        delay = self._delay(record)
+        if delay:
+            time.sleep(delay)
+        return self._response(record, None)
+
+
+class _TimedParser:
+    """Adds up the time spent in a streaming parser."""
+
+    __slots__ = ('parser', 'elapsed')
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.elapsed = 0.0
+
+    def feed(self, data):
+        started = time.perf_counter()
+        self.parser.feed(data)
+        self.elapsed += time.perf_counter() - started
+
+    def close(self):
+        started = time.perf_counter()
+        try:
+            return self.parser.close()
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+
 class Hub:
 
-    def __init__(self, serial, password):
-        self.session = requests.session()
+    # Keep-alive connections kept open to each ASN host
+    connections_per_host = 4
+    # Seconds allowed to open a connection, and between bytes of the
+    # response. Both apply to each attempt and are enforced on the socket.
+    connect_timeout = 3
+    read_timeout = 5
+    # Bytes read at a time when streaming a response into a parser
+    stream_chunk_size = 16384
+    # Only these endpoints are read-only and so safe to serve from cache
+    cacheable_endpoints = frozenset(['jstatus'])
+    # Devices left out of this many status responses in a row are
+    # forgotten; one response missing a device isn't enough
+    vanish_after = 3
+
+    def __init__(self, serial, password, client_session=None, auth_cache=None,
+                 circuit_breakers=None, cache_ttl=0, sample_store=None,
+                 director=None, metrics=None, transport=None,
+                 rolling_metrics=None, failure_threshold=1, poll_scheduler=None):
+        # Only the sync request() path uses this, so it's made on first use
+        self._session = None
         self.serial = serial
-        self.session.auth = HTTPDigestAuth(serial, password)
-        self.session.headers.update({
-            "Accept": "application/json",
-            "Content-Type": "application/json"})
+        self.protocol = HubProtocol(serial, password, director, auth_cache, metrics)
+        # Sends the protocol's requests; HttpTransport unless given
+        self.transport = transport if transport is not None else HttpTransport()
+        self._client_session = client_session
+        self._owns_client_session = client_session is None
+        # Keyed by host; pass a shared dict to share breakers between hubs
+        self._circuit_breakers = {} if circuit_breakers is None else circuit_breakers
+        # For breakers this hub creates; shared breakers need more than one
+        # failure, or one hub's bad luck suspends all of them
+        self.failure_threshold = failure_threshold
+        self.cache_ttl = cache_ttl
+        self.request_stats = RequestStats()
+        self._response_cache = {}
+        self._in_flight = {}
+        self.commands = CommandQueue(self)
+        # Optional SampleStore that every parsed device reading is added to
+        self.sample_store = sample_store
+        # Optional RollingMetrics, likewise fed every parsed reading
+        self.rolling_metrics = rolling_metrics
+        # Optional PollScheduler, told to expect a change whenever a
+        # command is submitted
+        self.poll_scheduler = poll_scheduler
         self._zappis = {}
         self._harvis = {}
-        self._asn = None
+        # The last status received for each device, by device type and
+        # serial, for snapshot()
+        self._last_status = {}
+        # Consecutive status responses each device has been missing from
+        self._missing = {}
 
     def __str__(self):
         return str(self.serial)
 
-    def async_request(self, m, params, order=None, sep=None):
-        loop = asyncio.get_running_loop()
-        return loop.run_in_executor(None, self.request, m, params, order, sep)
+    @property
+    def metrics(self):
+        """Optional MetricsSink that request timings and counts are sent to."""
+        return self.protocol.metrics
 
-    def request(self, m, params, order=None, sep=None):
-        # ugh. I want to use aiohttp, but the digest authentication makes this
-        # painful
-        resp = self.session.get(get_uri(m, params, order, sep, asn=self._asn))
-        if resp.status_code == 401 and 'x_myenergi-asn' in resp.headers:
-            self._asn = resp.headers['x_myenergi-asn']
-            return self.request(m, params, order, sep)
-        resp.raise_for_status()
-        return resp.json()
+    @metrics.setter
+    def metrics(self, metrics):
+        self.protocol.metrics = metrics
 
-    async def async_fetch_zappis(self):
-        response = await self.async_request('jstatus', {'id': 'Z'})
-        for zappi_data in response.get('zappi', []):
-            z = Zappi.from_json(zappi_data, self)
-            if z.serial in self._zappis:
+    @property
+    def session(self):
+        """The requests session for the sync ``request()`` path."""
+        if self._session is None:
+            self._session = requests.session()
+            self._session.headers.update(request_headers)
+        return self._session
+
+    def _get_client_session(self):
+        if self._client_session is None or self._client_session.closed:
+            self._client_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=self.connections_per_host),
+                headers=request_headers,
+            )
+            self._owns_client_session = True
+        return self._client_session
+
+    async def async_close(self):
+        """Close the HTTP client session, if this hub created it."""
+        await self.commands.async_cancel()
+        if self._owns_client_session and self._client_session is not None:
+            await self._client_session.close()
+        self._client_session = None
+
+    @property
+    def circuit_breaker(self):
+        """The circuit breaker for the host this hub currently talks to."""
+        return self._breaker(self.protocol.host)
+
+    def _breaker(self, host):
+        breaker = self._circuit_breakers.get(host)
+        if breaker is None:
+            breaker = self._circuit_breakers[host] = CircuitBreaker(
+                host, failure_threshold=self.failure_threshold)
+        return breaker
+
+    async def async_request(self, m, params, order=None, sep=None, use_cache=True,
+                            parser=None):
+        """Make a request, sharing the response between identical
+        concurrent calls and, if ``cache_ttl`` is set, later ones.
+
+        If ``parser`` is given the body is fed to it in chunks as it
+        arrives and the result of ``parser.close()`` is returned instead of
+        the decoded JSON. Only calls with the same class of parser, or
+        none, share a response.
+        """
+        key = (_request_path(get_uri(m, params, order, sep)),
+               None if parser is None else type(parser))
+        self.request_stats.requests += 1
+        cached = self._response_cache.get(key) if use_cache else None
+        if cached is not None and cached[0] > time.monotonic():
+            self.request_stats.cache_hits += 1
+            return cached[1]
+
+        flight = self._in_flight.get(key)
+        if flight is None:
+            task = asyncio.get_running_loop().create_task(
+                self._async_send(m, params, order, sep, parser))
+            task.add_done_callback(lambda t: self._flight_done(key, m, t))
+            # [task, number of callers waiting on it]
+            flight = self._in_flight[key] = [task, 0]
+        else:
+            self.request_stats.coalesced += 1
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if not flight[1] and not flight[0].done():
+                # Every caller gave up, so stop the request too
+                flight[0].cancel()
+                self.request_stats.abandoned += 1
+
+    def _flight_done(self, key, m, task):
+        if self._in_flight.get(key, [None])[0] is task:
+            del self._in_flight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.cache_ttl and m in self.cacheable_endpoints:
+            now = time.monotonic()
+            self._response_cache = {
+                k: v for k, v in self._response_cache.items() if v[0] > now}
+            self._response_cache[key] = (now + self.cache_ttl, task.result())
+
+    async def _async_send(self, m, params, order=None, sep=None, parser=None):
+        call = Call(m, params, order, sep)
+        if parser is not None and self.metrics is not None:
+            parser = _TimedParser(parser)
+        for attempt in range(self.protocol.max_request_attempts):
+            request = self.protocol.request(call)
+            # Each attempt counts against its own host, which changes when
+            # the director redirects to the ASN
+            breaker = self._breaker(request.host)
+            breaker.check()
+            started = time.perf_counter()
+            try:
+                response = await self.transport.async_send(self, request, parser)
+            except asyncio.TimeoutError:
+                self.request_stats.timeouts += 1
+                self._record_error(m, breaker, 'timeout')
+                breaker.record_failure()
+                raise
+            except (asyncio.CancelledError, aiohttp.ClientConnectionError) as e:
+                self._record_error(m, breaker, type(e).__name__)
+                breaker.record_failure()
+                raise
+            except Exception:
+                # Anything else means the server did answer
+                breaker.record_success()
+                raise
+            self._record_response(request, response, started)
+            if response.status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if not self.protocol.receive(request, response, attempt):
+                return self._decode(request, response, parser)
+
+    def _record_error(self, m, breaker, error):
+        if self.metrics is None:
+            return
+        self.metrics.increment('myenergi_request_errors_total', endpoint=m,
+                               host=breaker.host, error=error)
+
+    def _record_response(self, request, response, started):
+        metrics = self.metrics
+        if metrics is None:
+            return
+        m = request.call.m
+        metrics.observe('myenergi_http_request_seconds',
+                        time.perf_counter() - started, endpoint=m, host=request.host)
+        metrics.increment('myenergi_http_responses_total', endpoint=m,
+                          host=request.host, status=response.status)
+        if response.length:
+            metrics.increment('myenergi_http_response_bytes_total', response.length,
+                              endpoint=m, host=request.host)
+
+    def _decode(self, request, response, parser):
+        started = time.perf_counter()
+        result = self.protocol.decode(response, parser)
+        if self.metrics is not None:
+            # Streamed parsing overlaps with reading, so was timed as it went
+            elapsed = parser.elapsed if isinstance(parser, _TimedParser) \
+                else time.perf_counter() - started
+            self.metrics.observe('myenergi_decode_seconds', elapsed,
+                                 endpoint=request.call.m)
+        return result
+
+    def request(self, m, params, order=None, sep=None):
+        call = Call(m, params, order, sep)
+        for attempt in range(self.protocol.max_request_attempts):
+            request = self.protocol.request(call)
+            breaker = self._breaker(request.host)
+            breaker.check()
+            started = time.perf_counter()
+            try:
+                response = self.transport.send(self, request)
+            except requests.Timeout:
+                self.request_stats.timeouts += 1
+                self._record_error(m, breaker, 'timeout')
+                breaker.record_failure()
+                raise
+            except requests.ConnectionError as e:
+                self._record_error(m, breaker, type(e).__name__)
+                breaker.record_failure()
+                raise
+            except Exception:
+                breaker.record_success()
+                raise
+            self._record_response(request, response, started)
+            if response.status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if not self.protocol.receive(request, response, attempt):
+                return self._decode(request, response, None)
+
+    def _update_devices(self, device_cls, items, complete=False, report=True):
+        """Update devices from their statuses. If ``complete``, ``items``
+        covers every device of this type on the hub, and devices that keep
+        being left out are forgotten. ``report`` is passed to
+        ``from_json``."""
+        device_map = getattr(self, '_{}'.format(device_cls.device_map_key))
+        last_status = self._last_status.setdefault(device_cls.device_type.value, {})
+        for data in items:
+            d = device_cls.from_json(data, self, report)
+            device_map.setdefault(d.serial, d)
+            last_status[d.serial] = data
+        if complete:
+            self._forget_missing(device_cls, device_map, last_status,
+                                 {data['sno'] for data in items})
+        return list(device_map.values())
+
+    def _forget_missing(self, device_cls, device_map, last_status, present):
+        for serial in list(device_map):
+            key = (device_cls.device_map_key, serial)
+            if serial in present:
+                self._missing.pop(key, None)
                 continue
-            self._zappis[z.serial] = z
+            missed = self._missing[key] = self._missing.get(key, 0) + 1
+            if missed >= self.vanish_after:
+                logger.info('Forgetting %s, no longer reported by hub %s',
+                            device_map[serial], self)
+                if self.rolling_metrics is not None:
+                    self.rolling_metrics.forget(device_map[serial])
+                del device_map[serial]
+                last_status.pop(serial, None)
+                del self._missing[key]
+
+    def _update_from_status(self, response):
+        items = status_items(response)
+        return {
+            Zappi.device_map_key: self._update_devices(
+                Zappi, items.get('zappi', []), complete=True),
+            Harvi.device_map_key: self._update_devices(
+                Harvi, items.get('harvi', []), complete=True),
+        }
+
+    def snapshot(self):
+        """The last status of every known device, as JSON-serialisable
+        data for ``restore()``."""
+        return {
+            device_type: list(statuses.values())
+            for device_type, statuses in self._last_status.items()
+        }
+
+    def restore(self, snapshot):
+        """Recreate devices from ``snapshot()`` without making a request.
+
+        Returns a dict of device lists keyed by ``device_map_key``, like
+        ``async_fetch_all()``. Restored readings are not added to the
+        sample store, as they were stored when first received.
+        """
+        sample_store, self.sample_store = self.sample_store, None
+        try:
+            return self._update_from_status(snapshot)
+        finally:
+            self.sample_store = sample_store
+
+    async def async_fetch_all(self):
+        """Fetch every device on the hub in a single request.
+
+        Returns a dict of device lists keyed by ``device_map_key``.
+        """
+        response = await self.async_request(*status_call())
+        return self._update_from_status(response)
 
-        return list(self._zappis.values())
+    async def async_fetch_zappis(self):
+        response = await self.async_request(*status_call('Z'))
+        return self._update_devices(Zappi, response.get('zappi', []), complete=True)
 
     async def async_fetch_harvis(self):
-        response = await self.async_request('jstatus', {'id': 'H'})
-        for harvi_data in response.get('harvi', []):
-            h = Harvi.from_json(harvi_data, self)
-            if h.serial in self._harvis:
-                continue
-            self._harvis[h.serial] = h
-        return list(self._harvis.values())
+        response = await self.async_request(*status_call('H'))
+        return self._update_devices(Harvi, response.get('harvi', []), complete=True)
+
+    async def async_fetch_history(self, device, start, end, hourly=False,
+                                  max_concurrency=4):
+        """Fetch per-minute (or per-hour) history for ``device`` from
+        ``start`` to ``end`` inclusive.
+
+        Days are downloaded concurrently, at most ``max_concurrency`` at a
+        time, and each is parsed as it streams in. Returns a
+        HistorySeries.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch_day(day):
+            async with semaphore:
+                return await self.async_request(
+                    *history_call(device, day, hourly), parser=HistoryParser(day))
+
+        days = [start + datetime.timedelta(days=n)
+                for n in range((end - start).days + 1)]
+        return HistorySeries(await asyncio.gather(*[fetch_day(d) for d in days]))
 
     async def async_fetch_eddis(self):
-        response = await self.async_request('jstatus', {'id': 'E'})
+        response = await self.async_request(*status_call('E'))
         for eddi_data in response.get('eddi', []):
             pass
         return []
@@ -154,6 +1361,204 @@ class CommandStatus(enum.Enum):
     FINISHED = 3
 
 
+# Lookup tables for the parse path, which runs for every device on every
+# poll.
+
+_generator_keys = tuple(
+    ('ectt{}'.format(n), 'ectp{}'.format(n)) for n in range(1, 6))
+_ignored_generator_types = frozenset(['none', 'internal load'])
+_device_types = {t.value: t for t in DeviceType}
+_zappi_modes = {m.value: m for m in ZappiMode}
+
+# pst -> (status if sta is not listed, {sta: status})
+_zappi_status_default = (ZappiStatus.NOT_CONNECTED, {})
+_zappi_status_table = {
+    'A': _zappi_status_default,
+    'B1': (ZappiStatus.EV_WAITING, {
+        1: ZappiStatus.WAITING,
+        2: ZappiStatus.WAITING,
+        5: ZappiStatus.COMPLETE,
+    }),
+    'B2': (ZappiStatus.DELAYED, {5: ZappiStatus.COMPLETE}),
+    'C1': (ZappiStatus.WAITING, {
+        3: ZappiStatus.CHARGING,
+        4: ZappiStatus.BOOSTING,
+        5: ZappiStatus.COMPLETE,
+    }),
+    'C2': (ZappiStatus.CHARGING, {
+        4: ZappiStatus.BOOSTING,
+        5: ZappiStatus.COMPLETE,
+    }),
+    'F': (ZappiStatus.FAULT, {}),
+}
+
+# Devices on a hub usually report the same dat/tim, so remember the last one
+_last_timestamp = (None, None, None)
+
+
+def _parse_timestamp(dat, tim):
+    """Parse the ``dat`` (DD-MM-YYYY) and ``tim`` (HH:MM:SS) fields as UTC."""
+    global _last_timestamp
+    if _last_timestamp[0] == dat and _last_timestamp[1] == tim:
+        return _last_timestamp[2]
+    try:
+        if len(dat) != 10 or len(tim) != 8:
+            raise ValueError
+        dt = datetime.datetime(
+            int(dat[6:10]), int(dat[3:5]), int(dat[0:2]),
+            int(tim[0:2]), int(tim[3:5]), int(tim[6:8]),
+            tzinfo=pytz.UTC)
+    except ValueError:
+        # Not zero-padded, or not valid at all; let strptime decide
+        dt = datetime.datetime.strptime(
+            "{}T{}".format(dat, tim), "%d-%m-%YT%H:%M:%S"
+        ).replace(tzinfo=pytz.UTC)
+    _last_timestamp = (dat, tim, dt)
+    return dt
+
+
+class HistoryDay:
+    """Columns of history for one day.
+
+    Each column is an ``array.array``: ``timestamp`` holds UTC epoch
+    seconds for the start of each interval, and the energy columns hold
+    joules for the interval.
+    """
+
+    __slots__ = ('date', 'start', 'timestamp', 'imported', 'exported',
+                 'diverted', 'generated')
+
+    columns = ('timestamp', 'imported', 'exported', 'diverted', 'generated')
+
+    def __init__(self, date):
+        self.date = date
+        self.start = calendar.timegm(date.timetuple())
+        self.timestamp = array.array('q')
+        self.imported = array.array('d')
+        self.exported = array.array('d')
+        self.diverted = array.array('d')
+        self.generated = array.array('d')
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def append(self, record):
+        # Fields are left out of a record when they are zero
+        get = record.get
+        self.timestamp.append(
+            self.start + 3600 * get('hr', 0) + 60 * get('min', 0))
+        self.imported.append(get('imp', 0))
+        self.exported.append(get('exp', 0))
+        self.diverted.append(get('h1d', 0) + get('h2d', 0) + get('h3d', 0))
+        self.generated.append(get('gep', 0))
+
+
+class HistoryParser:
+    """Incrementally parses a ``jday``/``jdayhour`` response body.
+
+    The body is ``{"U<serial>": [{...}, ...]}``. Records are decoded one at
+    a time as bytes arrive and appended straight into a HistoryDay, so the
+    full list of dicts never exists at once.
+    """
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, date):
+        self.day = HistoryDay(date)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._in_array = False
+        self._done = False
+
+    def feed(self, data):
+        self._buffer = self._buffer[self._pos:] + self._text.decode(data)
+        self._pos = 0
+        self._parse()
+
+    def _parse(self):
+        buffer = self._buffer
+        append = self.day.append
+        if not self._in_array:
+            start = buffer.find('[')
+            if start < 0:
+                return
+            self._pos = start + 1
+            self._in_array = True
+        pos = self._pos
+        length = len(buffer)
+        while not self._done:
+            while pos < length and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= length:
+                break
+            if buffer[pos] == ']':
+                self._done = True
+                pos += 1
+                break
+            try:
+                record, end = self._decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Incomplete record; wait for more data
+                break
+            append(record)
+            pos = end
+        self._pos = pos
+
+    def close(self):
+        self.feed(b'')
+        if not self._in_array:
+            # Days without data come back as an object with no array
+            if not isinstance(json.loads(self._buffer or 'null'), dict):
+                raise ValueError('Unexpected history response for {}'.format(
+                    self.day.date))
+        elif not self._done:
+            raise ValueError('Truncated history response for {}'.format(
+                self.day.date))
+        return self.day
+
+
+class HistorySeries:
+    """A time series made of several HistoryDay chunks.
+
+    Columns are only concatenated when first asked for.
+    """
+
+    def __init__(self, days):
+        self.days = list(days)
+        self._columns = {}
+
+    def __len__(self):
+        return sum(len(d) for d in self.days)
+
+    def column(self, name):
+        if name not in HistoryDay.columns:
+            raise KeyError(name)
+        if name not in self._columns:
+            combined = None
+            for day in self.days:
+                if combined is None:
+                    combined = array.array(getattr(day, name).typecode)
+                combined.extend(getattr(day, name))
+            self._columns[name] = combined if combined is not None else array.array('d')
+        return self._columns[name]
+
+    def __getattr__(self, name):
+        if name in HistoryDay.columns:
+            return self.column(name)
+        raise AttributeError(name)
+
+    def to_numpy(self):
+        """Return a dict of NumPy arrays sharing memory with the columns.
+
+        Needs NumPy, which is not otherwise required.
+        """
+        return {
+            name: numpy.frombuffer(self.column(name), dtype=self.column(name).typecode)
+            for name in HistoryDay.columns
+        }
+
+
 class Schedule:
 
     def __init__(self, heater_type, slot, sub_slot, start_time, duration,
@@ -173,17 +1578,41 @@ class Schedule:
         )
 
 
+class Generator(collections.namedtuple('Generator', ['type', 'power', 'slot'])):
+    """One CT clamp reading. ``slot`` is the clamp's number on the device,
+    from 1, which unlike its position in ``Device.generators`` stays the
+    same when other clamps are added or removed. Also readable as
+    ``g['type']``/``g['power']``, as generators used to be plain dicts."""
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+
 class Device:
 
+    __slots__ = ('_Device__hub', 'serial', 'last_updated', 'generators',
+                 'changed', '_unreported', '__weakref__')
+
     device_type = None
     device_serial_prefix = None
     device_map_key = None
+    # Attributes compared across updates to work out what changed.
+    # last_updated is deliberately excluded as it moves on every poll.
+    tracked_fields = ('generators',)
 
     def __init__(self, serial, hub=None):
         self.__hub = weakref.ref(hub) if hub else None
         self.serial = serial
         self.last_updated = None
-        self.generators = []
+        self.generators = ()
+        # Names of tracked fields whose value changed in the last update
+        self.changed = frozenset()
+        # Changes seen by updates that weren't reported, for the next one
+        self._unreported = frozenset()
     
     @property
     def hub(self):
@@ -202,44 +1631,85 @@ class Device:
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, self.serial)
 
+    def generator(self, slot):
+        """The reading from CT clamp ``slot``, or None if it has none."""
+        for g in self.generators:
+            if g.slot == slot:
+                return g
+        return None
+
+    async def async_fetch_history(self, start, end, hourly=False):
+        """Fetch this device's history; see Hub.async_fetch_history."""
+        return await self.hub.async_fetch_history(self, start, end, hourly)
+
     def _update_from_json(self, data):
+        previous = self.generators
         generators = []
-        for n in range(1, 6):
-            g_name = 'ectt{}'.format(n)
-            if g_name not in data:
+        reused = 0
+        for slot, (type_key, power_key) in enumerate(_generator_keys, 1):
+            g_type = data.get(type_key)
+            if g_type is None:
                 break
-            if data[g_name].lower() in ('none', 'internal load'):
+            g_type = g_type.lower()
+            if g_type in _ignored_generator_types:
                 continue
-            try:
-                g = {
-                    'type': DeviceType(data['ectt{}'.format(n)].lower()),
-                    'power': data['ectp{}'.format(n)]
-                }
-                generators.append(g)
-            except (ValueError) as e:
+            device_type = _device_types.get(g_type)
+            if device_type is None:
                 # unsupported device type
-                #logger.warning('Unsupported device type {}'.format(data['ectt{}'.format(n)]))
-                logger.exception(e)
+                logger.warning('Unsupported device type %s', data[type_key])
                 continue
-        dt = datetime.datetime.strptime(
-            "{}T{}".format(data["dat"], data["tim"]), "%d-%m-%YT%H:%M:%S"
-        )
-        self.generators = generators
-        self.last_updated = dt.replace(tzinfo=pytz.UTC)
+            power = data[power_key]
+            i = len(generators)
+            # Readings mostly repeat, so keep the existing record if it
+            # matches rather than allocating a new one
+            if i < len(previous) and previous[i].type is device_type \
+                    and previous[i].power == power and previous[i].slot == slot:
+                generators.append(previous[i])
+                reused += 1
+            else:
+                generators.append(Generator(device_type, power, slot))
+        if reused != len(previous) or reused != len(generators):
+            self.generators = tuple(generators)
+        self.last_updated = _parse_timestamp(data["dat"], data["tim"])
 
     @classmethod
-    def from_json(cls, data, hub=None):
+    def from_json(cls, data, hub=None, report=True):
+        """Create or update the device from its status. Unless ``report``,
+        fields that changed are kept back for the next update's ``changed``
+        rather than replacing it."""
+        started = time.perf_counter()
         device_map = getattr(hub, '_{}'.format(cls.device_map_key))
         if hub is not None and data['sno'] in device_map:
             z = device_map[data['sno']]
         else:
             z = cls(data['sno'], hub)
+        before = [getattr(z, f, None) for f in cls.tracked_fields]
         z._update_from_json(data)
+        changed = frozenset(
+            f for f, old in zip(cls.tracked_fields, before)
+            if getattr(z, f, None) != old
+        )
+        if report:
+            z.changed = changed | z._unreported
+            z._unreported = frozenset()
+        else:
+            z._unreported |= changed
+        if hub is not None:
+            if hub.sample_store is not None:
+                hub.sample_store.append(z)
+            if hub.rolling_metrics is not None:
+                hub.rolling_metrics.add_device(z)
+            if hub.metrics is not None:
+                hub.metrics.observe('myenergi_parse_seconds',
+                                    time.perf_counter() - started,
+                                    device=cls.device_type.value)
         return z
 
 
 class Harvi(Device):
 
+    __slots__ = ()
+
     device_type = DeviceType.HARVI
     device_serial_prefix = 'H'
     device_map_key = 'harvis'
@@ -247,62 +1717,34 @@ class Harvi(Device):
 
 class Zappi(Device):
 
+    __slots__ = ('frequency', 'phase', 'status', 'voltage', 'power', 'priority',
+                 'command_status', 'mode', 'remaining_manual_boost',
+                 'remaining_smart_boost', 'current_charge',
+                 'minimum_green_level', 'smart_boost_target_time_minutes')
+
     device_type = DeviceType.ZAPPI
     device_serial_prefix = 'Z'
     device_map_key = 'zappis'
+    tracked_fields = Device.tracked_fields + (
+        'frequency', 'phase', 'status', 'voltage', 'power', 'priority',
+        'command_status', 'mode', 'remaining_manual_boost',
+        'remaining_smart_boost', 'current_charge', 'minimum_green_level',
+        'smart_boost_target_time_minutes',
+    )
 
     def _get_status(self, status, operating_mode):
-        if operating_mode == "A":
-            return ZappiStatus.NOT_CONNECTED
-        elif operating_mode == "B1":
-            if status in (1, 2):
-                return ZappiStatus.WAITING
-            elif status == 5:
-                return ZappiStatus.COMPLETE
-            return ZappiStatus.EV_WAITING
-        elif operating_mode == "B2":
-            if status == 5:
-                return ZappiStatus.COMPLETE
-            return ZappiStatus.DELAYED
-        elif operating_mode == "C1":
-            if status == 3:
-                return ZappiStatus.CHARGING
-            elif status == 4:
-                return ZappiStatus.BOOSTING
-            elif status == 5:
-                return ZappiStatus.COMPLETE
-            return ZappiStatus.WAITING
-        elif operating_mode == "C2":
-            if status == 4:
-                return ZappiStatus.BOOSTING
-            elif status == 5:
-                return ZappiStatus.COMPLETE
-            return ZappiStatus.CHARGING
-        elif operating_mode == "F":
-            return ZappiStatus.FAULT
-        return ZappiStatus.NOT_CONNECTED
+        default, by_status = _zappi_status_table.get(
+            operating_mode, _zappi_status_default)
+        return by_status.get(status, default)
 
     async def async_set_mode(self, mode=None, boost=None, kwh=0, target_time=None):
-        if mode is None:
-            mode = ZappiMode.NO_CHANGE
-        if boost is None:
-            boost = ZappiBoostMode.NO_CHANGE
-        if target_time is None:
-            target_time = '0000'
-        return self.hub.request(
-            'zappi-mode',
-            {
-                'id': self.serial,
-                'mode': mode.value,
-                'boost': boost.value,
-                'kwh': kwh,
-                'targetTime': target_time
-            },
-            ['id', 'mode', 'boost', 'kwh', 'targetTime']
-        )
+        """Change the mode and/or boost, returning the final CommandStatus
+        once the Zappi has finished (or failed) applying it."""
+        return await self.hub.commands.async_submit(
+            self, set_mode_call(self, mode, boost, kwh, target_time))
 
     async def get_timed_boost(self):
-        return self.hub.request('boost-time', {'id': self.serial})
+        return await self.hub.async_request(*boost_times_call(self))
 
     def _update_from_json(self, data):
         super(Zappi, self)._update_from_json(data)
@@ -313,13 +1755,15 @@ class Zappi(Device):
         self.voltage = data["vol"]
         self.power = data.get("div", 0)
         self.priority = data["pri"]
-        if data["cmt"] <= 10:
+        cmt = data["cmt"]
+        if cmt <= 10:
             self.command_status = CommandStatus.IN_PROGRESS
-        elif data["cmt"] == 253:
+        elif cmt == 253:
             self.command_status = CommandStatus.FAILED
         else:
             self.command_status = CommandStatus.FINISHED
-        self.mode = ZappiMode(data["zmo"])
+        mode = data["zmo"]
+        self.mode = _zappi_modes[mode] if mode in _zappi_modes else ZappiMode(mode)
         self.remaining_manual_boost = data.get("tbk", 0)
         self.remaining_smart_boost = data.get("sbk", 0)
         self.current_charge = data.get("che", 0)
@@ -327,24 +1771,1038 @@ class Zappi(Device):
         self.smart_boost_target_time_minutes = (60 * data.get("sbh", 0)) + data.get("sbm", 0)
 
 
-async def async_main(serial, password):
-    hub = Hub(serial, password)
-    zappis = await hub.async_fetch_zappis()
-    harvis = await hub.async_fetch_harvis()
-    print(zappis[0])
-    print(harvis[0])
-    print(zappis[0].generators)
-    print(harvis[0].generators)
+class CommandSupersededError(Exception):
+    """Raised to the caller of a command replaced before it was sent."""
+
+
+class CommandQueue:
+    """Sends Zappi commands for a hub without blocking the event loop.
+
+    Commands are sent one at a time per Zappi. A mode change submitted
+    while an earlier one for the same Zappi is still waiting to be sent is
+    merged into it, and both callers get the outcome of the merged
+    command. Any other command replaces the unsent one, whose caller gets
+    CommandSupersededError. After
+    sending, the Zappi's status is polled quickly until ``cmt`` reports the
+    command finished or failed.
+    """
+
+    def __init__(self, hub, timeout=60, min_poll_delay=0.5, max_poll_delay=5,
+                 settle_time=3):
+        self.__hub = weakref.ref(hub)
+        self.timeout = timeout
+        self.min_poll_delay = min_poll_delay
+        self.max_poll_delay = max_poll_delay
+        # A FINISHED status seen sooner than this after sending, without
+        # first seeing IN_PROGRESS, may still be from the previous command
+        self.settle_time = settle_time
+        self._pending = {}
+        self._workers = {}
+
+    @property
+    def hub(self):
+        return self.__hub()
+
+    async def async_submit(self, zappi, call):
+        if self.hub.poll_scheduler is not None:
+            self.hub.poll_scheduler.expect_change()
+        pending = self._pending.get(zappi.serial)
+        if pending is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[zappi.serial] = [zappi, call, future]
+        elif pending[1].m == call.m == 'zappi-mode':
+            logger.debug('Merging unsent mode changes for %s', zappi)
+            future = pending[2]
+            pending[1] = merge_set_mode_calls(pending[1], call)
+        else:
+            logger.debug('Replacing unsent command for %s', zappi)
+            pending[2].set_exception(CommandSupersededError(
+                'Command {} for {} replaced by {} before it was sent'.format(
+                    pending[1].m, zappi, call.m)))
+            future = asyncio.get_running_loop().create_future()
+            self._pending[zappi.serial] = [zappi, call, future]
+        worker = self._workers.get(zappi.serial)
+        if worker is None or worker.done():
+            self._workers[zappi.serial] = asyncio.get_running_loop().create_task(
+                self._async_work(zappi.serial))
+        # Other callers may be waiting on the same future
+        return await asyncio.shield(future)
+
+    async def _async_work(self, serial):
+        while serial in self._pending:
+            zappi, call, future = self._pending.pop(serial)
+            try:
+                status = await self._async_send(zappi, call)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(status)
+
+    async def _async_send(self, zappi, call):
+        loop = asyncio.get_running_loop()
+        sent_at = loop.time()
+        response = await self.hub.async_request(*call)
+        if isinstance(response, dict) and response.get('status', 0) != 0:
+            logger.warning('Command %s for %s rejected: %s', call.m, zappi,
+                           response.get('statustext'))
+            return CommandStatus.FAILED
+
+        delay = self.min_poll_delay
+        seen_in_progress = False
+        while loop.time() - sent_at < self.timeout:
+            await asyncio.sleep(delay)
+            status = await self.hub.async_request(*status_call(zappi), use_cache=False)
+            # Leave the change for the next regular poll to report
+            self.hub._update_devices(Zappi, status.get('zappi', []), report=False)
+            if zappi.command_status == CommandStatus.IN_PROGRESS:
+                seen_in_progress = True
+            elif seen_in_progress or loop.time() - sent_at >= self.settle_time:
+                return zappi.command_status
+            delay = min(self.max_poll_delay, delay * 1.5)
+        raise asyncio.TimeoutError(
+            'Command {} for {} did not complete in {} seconds'.format(
+                call.m, zappi, self.timeout))
+
+    async def async_cancel(self):
+        """Abandon all unsent and in-progress commands."""
+        workers = list(self._workers.values())
+        self._workers = {}
+        for pending in self._pending.values():
+            pending[2].cancel()
+        self._pending = {}
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+class SampleView:
+    """Zero-copy view of a range of samples from a SampleStore.
+
+    A range that wraps around the end of the ring is made of two
+    segments. Each segment is a memoryview of doubles straight onto the
+    memory-mapped file, ``len(SampleStore.fields)`` per sample. Release the
+    view before closing the store.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+
+    def __len__(self):
+        return sum(len(s) for s in self.segments) // len(SampleStore.fields)
+
+    def column(self, name):
+        """Return one strided memoryview per segment for a field."""
+        i = SampleStore.fields.index(name)
+        width = len(SampleStore.fields)
+        return [segment[i::width] for segment in self.segments]
+
+    def __iter__(self):
+        for segment in self.segments:
+            yield from SampleStore._record.iter_unpack(segment)
+
+    def release(self):
+        for segment in self.segments:
+            segment.release()
+        self.segments = []
+
+
+class SampleRing:
+    """Fixed-size ring of samples for one device in a memory-mapped file."""
+
+    _header = struct.Struct('<8sHHIQ')
+    header_size = 64
+    magic = b'MYENRING'
+    version = 1
+
+    def __init__(self, path, capacity):
+        record_size = SampleStore._record.size
+        exists = os.path.exists(path)
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if exists:
+            magic, version, width, capacity, count = self._header.unpack(
+                self._file.read(self._header.size))
+            if magic != self.magic or version != self.version \
+                    or width != len(SampleStore.fields):
+                self._file.close()
+                raise ValueError('{} is not a compatible sample file'.format(path))
+        else:
+            count = 0
+            self._file.truncate(self.header_size + capacity * record_size)
+        self.capacity = capacity
+        self.count = count
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._doubles = memoryview(self._mmap)[self.header_size:].cast('d')
+        self._write_header()
+
+    def _write_header(self):
+        self._header.pack_into(
+            self._mmap, 0, self.magic, self.version, len(SampleStore.fields),
+            self.capacity, self.count)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _timestamp(self, i):
+        """Timestamp of the i-th oldest sample still in the ring."""
+        slot = (self.count - len(self) + i) % self.capacity
+        return self._doubles[slot * len(SampleStore.fields)]
+
+    def append(self, values):
+        if len(self) and values[0] <= self._timestamp(len(self) - 1):
+            # Already have this reading (or a later one)
+            return False
+        slot = self.count % self.capacity
+        SampleStore._record.pack_into(
+            self._mmap, self.header_size + slot * SampleStore._record.size,
+            *values)
+        self.count += 1
+        self._write_header()
+        return True
+
+    def _bisect(self, timestamp):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, start, end):
+        first = self._bisect(start)
+        last = self._bisect(end)
+        width = len(SampleStore.fields)
+        oldest = self.count - len(self)
+        segments = []
+        while first < last:
+            slot = (oldest + first) % self.capacity
+            n = min(last - first, self.capacity - slot)
+            segments.append(self._doubles[slot * width:(slot + n) * width])
+            first += n
+        return SampleView(segments)
+
+    def close(self):
+        self._doubles.release()
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+
+class SampleStore:
+    """Keeps recent readings for each device on disk.
+
+    Every sample is a fixed-width record of doubles appended to a ring
+    file per device (``<dir>/<device>.ring``), so the files never grow
+    beyond ``capacity`` samples. Missing values are stored as NaN,
+    ``status`` is the ZappiStatus value and ``generator_<n>`` is the power
+    from CT clamp slot n. The default capacity is a week of 10 second
+    polls.
+    """
+
+    max_generators = 5
+    fields = ('timestamp', 'power', 'voltage', 'frequency', 'status') + tuple(
+        'generator_{}'.format(n) for n in range(1, max_generators + 1))
+    _record = struct.Struct('<{}d'.format(len(fields)))
+
+    def __init__(self, directory, capacity=7 * 24 * 360):
+        self.directory = directory
+        self.capacity = capacity
+        self._rings = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _ring(self, name):
+        ring = self._rings.get(name)
+        if ring is None:
+            ring = self._rings[name] = SampleRing(
+                os.path.join(self.directory, '{}.ring'.format(name)),
+                self.capacity)
+        return ring
+
+    def append(self, device):
+        """Store the device's current reading; returns False if it was
+        already stored."""
+        if device.last_updated is None:
+            return False
+        nan = math.nan
+        status = getattr(device, 'status', None)
+        values = [
+            device.last_updated.timestamp(),
+            getattr(device, 'power', nan),
+            getattr(device, 'voltage', nan),
+            getattr(device, 'frequency', nan),
+            status.value if status is not None else nan,
+        ]
+        powers = [nan] * self.max_generators
+        for g in device.generators:
+            if g.slot <= self.max_generators:
+                powers[g.slot - 1] = g.power
+        values.extend(powers)
+        return self._ring(str(device)).append(values)
+
+    def query(self, device, start, end):
+        """Return a SampleView of samples for ``device`` (a Device or its
+        name, e.g. ``'Z12345678'``) with ``start <= timestamp < end``.
+
+        ``start`` and ``end`` are datetimes or epoch seconds.
+        """
+        if isinstance(start, datetime.datetime):
+            start = start.timestamp()
+        if isinstance(end, datetime.datetime):
+            end = end.timestamp()
+        return self._ring(str(device)).query(start, end)
+
+    def close(self):
+        for ring in self._rings.values():
+            ring.close()
+        self._rings = {}
+
+
+def _positive_area(p0, p1, dt):
+    """Area under the positive part of a line from p0 to p1 over dt."""
+    if p0 >= 0 and p1 >= 0:
+        return (p0 + p1) / 2 * dt
+    if p0 <= 0 and p1 <= 0:
+        return 0.0
+    # Crosses zero; only the triangle above it counts
+    high = max(p0, p1)
+    return high * high / (abs(p0) + abs(p1)) * dt / 2
+
+
+def _positive_areas(p0, p1, dt):
+    """Vectorised _positive_area over NumPy arrays."""
+    high = numpy.maximum(p0, p1)
+    low = numpy.minimum(p0, p1)
+    span = numpy.where(high > low, high - low, 1)
+    crossing = high * high / span * dt / 2
+    return numpy.where(
+        low >= 0, (p0 + p1) / 2 * dt,
+        numpy.where(high <= 0, 0.0, crossing))
+
+
+class EnergyMeter:
+    """Turns power readings from a hub into cumulative kWh counters.
+
+    Readings are buffered and integrated a batch at a time with the
+    trapezoidal rule, using NumPy when it is installed. Batches are sorted
+    by time first, keeping readings with the same time in the order they
+    were added, so both ways give the same totals. Readings older than the last integrated one are
+    dropped, and no energy is counted across gaps longer than ``max_gap``
+    seconds.
+
+    Grid power is positive when importing. Home consumption is what the
+    grid, solar and battery supply minus what the Zappis divert.
+    """
+
+    channels = ('grid_import', 'grid_export', 'solar', 'ev', 'home')
+    joules_per_kwh = 3.6e6
+    _columns = ('time', 'grid', 'solar', 'battery', 'ev')
+
+    def __init__(self, batch_size=30, max_gap=300):
+        self.batch_size = batch_size
+        self.max_gap = max_gap
+        self.totals = dict.fromkeys(self.channels, 0.0)
+        self.dropped = 0
+        self._samples = {k: array.array('d') for k in self._columns}
+        # Last integrated reading, carried into the next batch
+        self._last = None
+
+    def add_sample(self, timestamp, grid=0.0, solar=0.0, battery=0.0, ev=0.0):
+        """Add one reading (epoch seconds and watts). Returns True if a
+        batch was integrated and the totals changed."""
+        samples = self._samples
+        samples['time'].append(timestamp)
+        samples['grid'].append(grid)
+        samples['solar'].append(solar)
+        samples['battery'].append(battery)
+        samples['ev'].append(ev)
+        if len(samples['time']) >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def add_devices(self, devices):
+        """Add one reading summed across a hub's devices."""
+        powers = {DeviceType.POWER_GRID: 0.0, DeviceType.SOLAR_PANEL: 0.0,
+                  DeviceType.BATTERY: 0.0}
+        ev = 0.0
+        timestamp = None
+        for device in devices:
+            if device.last_updated is None:
+                continue
+            ts = device.last_updated.timestamp()
+            timestamp = ts if timestamp is None else max(timestamp, ts)
+            for g in device.generators:
+                if g.type in powers:
+                    powers[g.type] += g.power
+            if device.device_type is DeviceType.ZAPPI:
+                ev += device.power
+        if timestamp is None:
+            return False
+        return self.add_sample(
+            timestamp, powers[DeviceType.POWER_GRID],
+            powers[DeviceType.SOLAR_PANEL], powers[DeviceType.BATTERY], ev)
+
+    def flush(self):
+        """Integrate all buffered readings into the totals."""
+        columns = [self._samples[k] for k in self._columns]
+        if numpy is not None:
+            data = numpy.vstack([numpy.frombuffer(c, dtype=float) for c in columns])
+        else:
+            # By time alone, like the stable sort in _flush_numpy
+            rows = sorted(zip(*columns), key=lambda row: row[0])
+        for column in columns:
+            del column[:]
+        if numpy is not None:
+            self._flush_numpy(data)
+        else:
+            self._flush(rows)
+
+    def _add(self, joules):
+        for channel, value in zip(self.channels, joules):
+            self.totals[channel] += float(value) / self.joules_per_kwh
+
+    def _flush(self, rows):
+        if self._last is not None:
+            kept = [r for r in rows if r[0] > self._last[0]]
+            self.dropped += len(rows) - len(kept)
+            rows = [self._last] + kept
+        if not rows:
+            return
+        self._last = rows[-1]
+        joules = [0.0] * len(self.channels)
+        for (t0, g0, s0, b0, e0), (t1, g1, s1, b1, e1) in zip(rows, rows[1:]):
+            dt = t1 - t0
+            if dt <= 0 or dt > self.max_gap:
+                continue
+            joules[0] += _positive_area(g0, g1, dt)
+            joules[1] += _positive_area(-g0, -g1, dt)
+            joules[2] += _positive_area(s0, s1, dt)
+            joules[3] += (e0 + e1) / 2 * dt
+            joules[4] += _positive_area(g0 + s0 + b0 - e0, g1 + s1 + b1 - e1, dt)
+        self._add(joules)
+
+    def _flush_numpy(self, data):
+        data = data[:, numpy.argsort(data[0], kind='stable')]
+        if self._last is not None:
+            kept = data[0] > self._last[0]
+            self.dropped += int(data.shape[1] - kept.sum())
+            data = numpy.hstack([numpy.array(self._last)[:, None], data[:, kept]])
+        if not data.shape[1]:
+            return
+        self._last = tuple(data[:, -1].tolist())
+        t, grid, solar, battery, ev = data
+        dt = numpy.diff(t)
+        dt = numpy.where((dt > 0) & (dt <= self.max_gap), dt, 0.0)
+        home = grid + solar + battery - ev
+        self._add([
+            _positive_areas(grid[:-1], grid[1:], dt).sum(),
+            _positive_areas(-grid[:-1], -grid[1:], dt).sum(),
+            _positive_areas(solar[:-1], solar[1:], dt).sum(),
+            ((ev[:-1] + ev[1:]) / 2 * dt).sum(),
+            _positive_areas(home[:-1], home[1:], dt).sum(),
+        ])
+
+
+class RollingWindow:
+    """The mean, minimum and maximum of the readings from the last
+    ``seconds``, and their exponentially weighted moving average with a
+    time constant of ``seconds``. Each reading costs amortised O(1),
+    however many the window holds.
+
+    The mean is of the readings, not weighted by the time between them.
+    All are None until the first reading.
+    """
+
+    __slots__ = ('seconds', 'ewma', '_time', '_sum', '_samples', '_min', '_max')
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.ewma = None
+        self._time = None
+        self._sum = 0.0
+        self._samples = collections.deque()
+        # (time, value) candidates for the minimum and maximum, oldest
+        # first; a reading is dropped once a later one is as low (high)
+        self._min = collections.deque()
+        self._max = collections.deque()
+
+    def add(self, timestamp, value):
+        """Add a reading at ``timestamp`` (epoch seconds), which must not
+        be earlier than the last."""
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            alpha = 1 - math.exp(-(timestamp - self._time) / self.seconds)
+            self.ewma += alpha * (value - self.ewma)
+        self._time = timestamp
+        self._samples.append((timestamp, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        self._expire(timestamp - self.seconds)
+
+    def _expire(self, cutoff):
+        samples = self._samples
+        while samples[0][0] <= cutoff:
+            self._sum -= samples.popleft()[1]
+        for candidates in (self._min, self._max):
+            while candidates[0][0] <= cutoff:
+                candidates.popleft()
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def mean(self):
+        return self._sum / len(self._samples) if self._samples else None
+
+    @property
+    def minimum(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def maximum(self):
+        return self._max[0][1] if self._max else None
+
+
+class RollingMetrics:
+    """Rolling statistics of a hub's site power, kept up to date as each
+    device reading is parsed so that reading them never needs history.
+
+    Every quantity has a RollingWindow for each of ``windows`` (seconds).
+    The quantities, in watts, are as for EnergyMeter:
+
+    * ``grid``: positive when importing
+    * ``solar``: generation
+    * ``ev``: what the Zappis divert
+    * ``surplus``: solar generation less home consumption, which is
+      what could go to an EV without importing
+    * ``export``: power sent to the grid
+
+    The site totals hold each device's last reading, so a reading from one
+    device is combined with the latest from the others. Readings with the
+    same timestamp, as from one status response, make a single sample, and
+    readings no newer than the last sample make none.
+    """
+
+    quantities = ('grid', 'solar', 'ev', 'surplus', 'export')
+    windows = (60, 300, 900)
+
+    def __init__(self, windows=None):
+        if windows is not None:
+            self.windows = tuple(windows)
+        self._windows = {
+            q: {seconds: RollingWindow(seconds) for seconds in self.windows}
+            for q in self.quantities
+        }
+        # Last (grid, solar, battery, ev) reading by device serial
+        self._readings = {}
+        self._site = (0.0, 0.0, 0.0, 0.0)
+        # Timestamp of the readings not yet added to the windows
+        self._pending = None
+        self.last_updated = None
+
+    def add_device(self, device):
+        """Update the site totals with a device's latest reading."""
+        if device.last_updated is None:
+            return
+        timestamp = device.last_updated.timestamp()
+        powers = {DeviceType.POWER_GRID: 0.0, DeviceType.SOLAR_PANEL: 0.0,
+                  DeviceType.BATTERY: 0.0}
+        for g in device.generators:
+            if g.type in powers:
+                powers[g.type] += g.power
+        reading = (
+            powers[DeviceType.POWER_GRID], powers[DeviceType.SOLAR_PANEL],
+            powers[DeviceType.BATTERY],
+            device.power if device.device_type is DeviceType.ZAPPI else 0.0,
+        )
+        if self._pending is not None and timestamp > self._pending:
+            self.flush()
+        self._set_reading(device.serial, reading)
+        # A reading no newer than the last sample still counts towards the
+        # totals but doesn't make a sample, so a hub repeating the same
+        # status while offline can't fill the windows
+        if self._pending is None and (
+                self.last_updated is None or timestamp > self.last_updated):
+            self._pending = timestamp
+
+    def forget(self, device):
+        """Stop counting a device that is no longer reported."""
+        self._set_reading(device.serial, None)
+
+    def _set_reading(self, serial, reading):
+        previous = self._readings.pop(serial, None)
+        site = self._site
+        if previous is not None:
+            site = tuple(s - p for s, p in zip(site, previous))
+        if reading is not None:
+            self._readings[serial] = reading
+            site = tuple(s + r for s, r in zip(site, reading))
+        self._site = site
+
+    def flush(self):
+        """Add the pending sample to the windows."""
+        if self._pending is None:
+            return
+        timestamp, self._pending = self._pending, None
+        grid, solar, battery, ev = self._site
+        home = grid + solar + battery - ev
+        values = {
+            'grid': grid,
+            'solar': solar,
+            'ev': ev,
+            'surplus': solar - home,
+            'export': max(-grid, 0.0),
+        }
+        for quantity, windows in self._windows.items():
+            value = values[quantity]
+            for window in windows.values():
+                window.add(timestamp, value)
+        self.last_updated = timestamp
+
+    def window(self, quantity, seconds):
+        """The RollingWindow of ``quantity`` over ``seconds``."""
+        self.flush()
+        return self._windows[quantity][seconds]
+
+    def self_consumption(self, seconds):
+        """The share of solar generation over ``seconds`` used on site
+        rather than exported, from 0 to 1, or None without any."""
+        solar = self.window('solar', seconds).mean
+        export = self.window('export', seconds).mean
+        if not solar or solar <= 0:
+            return None
+        return min(max(1 - export / solar, 0.0), 1.0)
+
+
+class PollScheduler:
+    """Works out how long to wait before polling a hub again.
+
+    Polls at ``min_interval`` while a Zappi is charging or boosting, a
+    command is pending or a Zappi's power has moved by ``power_threshold``
+    watts, at ``interval`` while a car is plugged in, and otherwise
+    stretches the wait by ``idle_growth`` each quiet poll up to
+    ``max_interval``. CT clamp readings are left out, as household load
+    keeps whole-site power moving even when nothing is happening.
+    """
+
+    active_statuses = frozenset([ZappiStatus.CHARGING, ZappiStatus.BOOSTING])
+    connected_statuses = frozenset([
+        ZappiStatus.EV_WAITING, ZappiStatus.WAITING, ZappiStatus.DELAYED])
+
+    def __init__(self, interval=10, min_interval=5, max_interval=120,
+                 idle_growth=1.5, power_threshold=50, jitter=0.1):
+        self.default_interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_growth = idle_growth
+        self.power_threshold = power_threshold
+        self.jitter = jitter
+        self.interval = interval
+        self._last_powers = {}
+        self._expect_change_until = 0
+
+    def expect_change(self, duration=60):
+        """Poll quickly for a while, e.g. after sending a command."""
+        self._expect_change_until = max(
+            self._expect_change_until, time.monotonic() + duration)
+
+    def _power_moved(self, device):
+        power = getattr(device, 'power', None)
+        if power is None:
+            return False
+        last = self._last_powers.get(device.serial)
+        self._last_powers[device.serial] = power
+        return last is None or abs(power - last) >= self.power_threshold
+
+    def next_interval(self, devices):
+        """Return seconds until the next poll given the freshly polled
+        devices."""
+        devices = list(devices)
+        # Always check every device so that the stored powers stay current
+        moved = [self._power_moved(d) for d in devices]
+        if len(self._last_powers) > len(devices):
+            serials = {d.serial for d in devices}
+            self._last_powers = {
+                k: v for k, v in self._last_powers.items() if k in serials}
+        statuses = {getattr(d, 'status', None) for d in devices}
+        active = (
+            any(moved)
+            or statuses & self.active_statuses
+            or any(getattr(d, 'command_status', None) == CommandStatus.IN_PROGRESS
+                   for d in devices)
+            or time.monotonic() < self._expect_change_until
+        )
+        if active:
+            self.interval = self.min_interval
+        elif statuses & self.connected_statuses:
+            self.interval = self.default_interval
+        else:
+            self.interval = min(
+                self.max_interval,
+                max(self.interval, self.default_interval) * self.idle_growth)
+        jittered = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(self.max_interval, max(self.min_interval, jittered))
+
+
+class Fleet:
+    """Polls many hubs from one process.
+
+    At most ``max_concurrency`` requests are in flight at once, hubs are
+    spread across the poll interval instead of all firing together, and
+    every hub shares one HTTP session so connections to each ASN host are
+    pooled between hubs.
+    """
+
+    connections_per_host = 16
+    # Consecutive failures, from any hub, before a shared breaker opens;
+    # occasional errors are spread across hubs rather than suspending all
+    failure_threshold = 5
+
+    def __init__(self, interval=10, max_concurrency=10, auth_cache=None,
+                 director=None, metrics=None, on_poll=None, transport=None):
+        self.interval = interval
+        self.max_concurrency = max_concurrency
+        self.auth_cache = auth_cache
+        self.director = director
+        # Optional MetricsSink shared by every hub
+        self.metrics = metrics
+        # Optional coroutine function called with each hub and its devices
+        # after a successful poll. The hub's next poll waits for it.
+        self.on_poll = on_poll
+        # Optional transport for every hub, e.g. to record or replay
+        self.transport = transport
+        self.hubs = {}
+        self.results = {}
+        self.errors = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # One breaker per ASN host, shared by every hub on it
+        self.circuit_breakers = {}
+        self._client_session = None
+        self._tasks = {}
+        self._running = False
+
+    def _get_client_session(self):
+        if self._client_session is None or self._client_session.closed:
+            self._client_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0, limit_per_host=self.connections_per_host),
+                headers=request_headers,
+            )
+        return self._client_session
+
+    def add_hub(self, serial, password):
+        hub = Hub(serial, password, auth_cache=self.auth_cache,
+                  circuit_breakers=self.circuit_breakers, director=self.director,
+                  metrics=self.metrics, failure_threshold=self.failure_threshold,
+                  transport=self.transport)
+        hub._owns_client_session = False
+        self.hubs[hub.serial] = hub
+        if self._running:
+            # Hubs joining a running fleet land at a random point in the
+            # interval rather than all on the next tick
+            self._start_polling(hub, random.uniform(0, self.interval))
+        return hub
+
+    def remove_hub(self, serial):
+        hub = self.hubs.pop(serial)
+        task = self._tasks.pop(serial, None)
+        if task is not None:
+            task.cancel()
+        self.results.pop(serial, None)
+        self.errors.pop(serial, None)
+        return hub
+
+    @property
+    def devices(self):
+        """All devices across every hub, keyed by ``device_map_key``."""
+        devices = {}
+        for result in self.results.values():
+            for key, items in result.items():
+                devices.setdefault(key, []).extend(items)
+        return devices
+
+    async def async_poll_hub(self, hub):
+        async with self._semaphore:
+            hub._client_session = self._get_client_session()
+            started = time.perf_counter()
+            try:
+                result = self.results[hub.serial] = await hub.async_fetch_all()
+            except (asyncio.TimeoutError, aiohttp.ClientError, ResponseError,
+                    DecodeError, CircuitOpenError) as e:
+                logger.warning('Error while polling hub %s: %s', hub, e)
+                self.errors[hub.serial] = e
+                result = None
+            except Exception as e:
+                # e.g. a KeyError from a status missing a field
+                logger.exception('Unexpected error while polling hub %s', hub)
+                self.errors[hub.serial] = e
+                result = None
+            else:
+                self.errors.pop(hub.serial, None)
+            if self.metrics is not None:
+                self.metrics.observe('myenergi_poll_seconds',
+                                     time.perf_counter() - started, hub=str(hub))
+        if result is not None and self.on_poll is not None:
+            await self.on_poll(hub, result)
+
+    async def async_poll_all(self):
+        """Poll every hub once, bounded by the concurrency limit."""
+        await asyncio.gather(*[
+            self.async_poll_hub(hub) for hub in list(self.hubs.values())
+        ])
+
+    async def _async_poll_loop(self, hub, offset):
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time() + offset
+        while True:
+            await asyncio.sleep(max(0, next_poll - loop.time()))
+            try:
+                await self.async_poll_hub(hub)
+            except Exception:
+                # Keep polling whatever went wrong, e.g. in on_poll
+                logger.exception('Error after polling hub %s', hub)
+            next_poll += self.interval
+            if next_poll < loop.time():
+                # Fell behind; skip the missed slots rather than bursting
+                missed = math.ceil((loop.time() - next_poll) / self.interval)
+                next_poll += missed * self.interval
+
+    def _start_polling(self, hub, offset):
+        self._tasks[hub.serial] = asyncio.get_running_loop().create_task(
+            self._async_poll_loop(hub, offset))
+
+    async def async_start(self):
+        """Start polling every hub, staggered evenly across the interval."""
+        if self._running:
+            return
+        self._running = True
+        hubs = list(self.hubs.values())
+        for i, hub in enumerate(hubs):
+            self._start_polling(hub, i * self.interval / len(hubs))
+
+    async def async_stop(self):
+        self._running = False
+        tasks = list(self._tasks.values())
+        self._tasks = {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._client_session is not None:
+            await self._client_session.close()
+            self._client_session = None
+
+
+def _flatten_fields(device, fields):
+    """(name, value) pairs for ``fields`` of a device, with generators
+    spread over fields numbered by CT slot and enums given by name."""
+    for name in fields:
+        value = getattr(device, name, None)
+        if name == 'generators':
+            for g in value:
+                yield 'generator_{}_type'.format(g.slot), g.type.value
+                yield 'generator_{}_power'.format(g.slot), g.power
+        elif isinstance(value, enum.Enum):
+            yield name, value.name.lower()
+        else:
+            yield name, value
+
+
+class Monitor:
+    """Streams device readings from a Fleet as NDJSON or CSV.
+
+    NDJSON has one object per device reading. CSV has one
+    ``time,hub,device,field,value`` row per field, so that readings with
+    only their changed fields (``changes_only``) still fit one header.
+
+    Lines wait in a queue of at most ``buffer_size``. When the output
+    can't keep up the queue fills and polling waits for it, rather than
+    readings piling up in memory.
+    """
+
+    formats = ('ndjson', 'csv')
+    csv_header = ('time', 'hub', 'device', 'field', 'value')
+
+    def __init__(self, fleet, output=None, format='ndjson', changes_only=False,
+                 buffer_size=1000):
+        if format not in self.formats:
+            raise ValueError('Unknown format {}'.format(format))
+        self.fleet = fleet
+        self.output = output if output is not None else sys.stdout
+        self.format = format
+        self.changes_only = changes_only
+        self.buffer_size = buffer_size
+        self.written = 0
+        self._queue = None
+        self._writer = None
+        self._csv_buffer = io.StringIO()
+        self._csv = csv.writer(self._csv_buffer, lineterminator='\n')
+        fleet.on_poll = self.async_add
+
+    def _lines(self, hub, device):
+        fields = device.changed if self.changes_only else device.tracked_fields
+        if not fields:
+            return []
+        # Keep a stable field order whatever order changed is in
+        fields = [f for f in device.tracked_fields if f in fields]
+        timestamp = device.last_updated.isoformat() if device.last_updated else None
+        values = _flatten_fields(device, fields)
+        if self.format == 'ndjson':
+            record = {'time': timestamp, 'hub': str(hub), 'device': str(device)}
+            record.update(values)
+            return [json.dumps(record, separators=(',', ':')) + '\n']
+        buffer = self._csv_buffer
+        buffer.seek(0)
+        buffer.truncate()
+        self._csv.writerows(
+            (timestamp, str(hub), str(device), name, value) for name, value in values)
+        return [buffer.getvalue()]
+
+    async def async_add(self, hub, devices):
+        """Queue lines for every device in a poll result, waiting while
+        the queue is full."""
+        for device_list in devices.values():
+            for device in device_list:
+                for line in self._lines(hub, device):
+                    await self._queue.put(line)
+
+    async def _async_open_output(self):
+        """A function that writes a string and waits for it to drain, and
+        one to call when done writing, or None."""
+        try:
+            fd = self.output.fileno()
+        except (AttributeError, ValueError, io.UnsupportedOperation):
+            fd = None
+        if fd is None or not stat.S_ISFIFO(os.fstat(fd).st_mode):
+            # Terminals, regular files and in-memory streams are written
+            # to directly. A pipe transport would make a terminal
+            # non-blocking for the shell and everything else sharing it.
+            async def write(data):
+                self.output.write(data)
+                self.output.flush()
+            return write, None
+
+        loop = asyncio.get_running_loop()
+        self.output.flush()
+        # The pipe transport makes the pipe non-blocking; undo that after,
+        # for whoever else writes to it
+        blocking = os.get_blocking(fd)
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, self.output)
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+        async def write(data):
+            writer.write(data.encode())
+            await writer.drain()
+
+        def close():
+            os.set_blocking(fd, blocking)
+        return write, close
+
+    async def _async_write(self):
+        write, close = await self._async_open_output()
+        try:
+            if self.format == 'csv':
+                await write(','.join(self.csv_header) + '\n')
+            while True:
+                lines = [await self._queue.get()]
+                while not self._queue.empty():
+                    lines.append(self._queue.get_nowait())
+                await write(''.join(lines))
+                self.written += len(lines)
+                for _ in lines:
+                    self._queue.task_done()
+        finally:
+            if close is not None:
+                close()
+
+    async def async_start(self):
+        self._queue = asyncio.Queue(self.buffer_size)
+        self._writer = asyncio.get_running_loop().create_task(self._async_write())
+
+    async def async_wait(self):
+        """Wait until the output stops, which only happens if it fails,
+        e.g. because the reader went away."""
+        await self._writer
+
+    async def async_stop(self):
+        """Write out anything still queued, then stop."""
+        if not self._writer.done():
+            drained = asyncio.ensure_future(self._queue.join())
+            await asyncio.wait([drained, self._writer],
+                               return_when=asyncio.FIRST_COMPLETED)
+            drained.cancel()
+        self._writer.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
+
+
+async def async_main(args):
+    fleet = Fleet(interval=args.interval, max_concurrency=args.concurrency,
+                  director=args.director)
+    for serial, password in args.hubs:
+        fleet.add_hub(serial, password)
+    monitor = Monitor(fleet, sys.stdout, args.format, args.changes_only, args.buffer)
+    await monitor.async_start()
+    try:
+        if args.once:
+            await fleet.async_poll_all()
+        else:
+            await fleet.async_start()
+            await monitor.async_wait()
+    finally:
+        await fleet.async_stop()
+        await monitor.async_stop()
+
+
+def _hub_arg(value):
+    serial, sep, password = value.partition(':')
+    if not sep or not serial or not password:
+        raise argparse.ArgumentTypeError('expected SERIAL:PASSWORD')
+    return serial, password
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
-
-    serial = argv[0]
-    password = argv[1]
-
-    asyncio.run(async_main(serial, password))
+    # The original form, "serial password", for a single hub
+    if len(argv) == 2 and ':' not in argv[0] and not argv[0].startswith('-'):
+        argv = ['{}:{}'.format(*argv)]
+
+    parser = argparse.ArgumentParser(
+        description='Stream readings from MyEnergi hubs to stdout.')
+    parser.add_argument('hubs', nargs='+', type=_hub_arg, metavar='SERIAL:PASSWORD')
+    parser.add_argument('--format', choices=Monitor.formats, default='ndjson')
+    parser.add_argument('--changes-only', action='store_true',
+                        help='only output fields that changed since the last poll')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between polls of each hub')
+    parser.add_argument('--once', action='store_true',
+                        help='poll every hub once and exit')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='hubs polled at once')
+    parser.add_argument('--buffer', type=int, default=1000,
+                        help='lines held while the output catches up')
+    parser.add_argument('--director', help='director URL, e.g. a mock director')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    try:
+        asyncio.run(async_main(args))
+    except (KeyboardInterrupt, BrokenPipeError, ConnectionResetError):
+        # Stopped, or whatever was reading the output went away
+        pass
 
 
 if __name__ == '__main__':
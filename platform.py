@@ -4,13 +4,17 @@
 import asyncio
 from datetime import timedelta
 import logging
+import time
 
+import aiohttp
+from aiohttp import web
 import async_timeout
 from requests.exceptions import RequestException
 import voluptuous as vol
 
+from homeassistant.components.http import HomeAssistantView
 from homeassistant.const import (
-    CONF_USERNAME, CONF_DEVICES, CONF_PASSWORD)
+    CONF_USERNAME, CONF_DEVICES, CONF_PASSWORD, EVENT_HOMEASSISTANT_STOP)
 from homeassistant.helpers import discovery
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.event import async_track_point_in_utc_time
@@ -40,6 +44,10 @@ ATTR_MODE_ECO_PLUS = 'Eco-Plus'
 ATTR_POWER = 'power'
 ATTR_VOLTAGE = 'voltage'
 ATTR_LAST_UPDATED = 'last_updated'
+ATTR_EWMA = 'ewma'
+ATTR_MINIMUM = 'minimum'
+ATTR_MAXIMUM = 'maximum'
+ATTR_SAMPLES = 'samples'
 
 DEVICE_SCHEMA = vol.Schema({
     vol.Required(CONF_USERNAME): cv.string,
@@ -51,15 +59,69 @@ CONFIG_SCHEMA = vol.Schema({
 }, extra=vol.ALLOW_EXTRA)
 
 
+class DeviceCoordinator:
+    """Pushes a device's new readings to all of its entities at once."""
+
+    def __init__(self, device):
+        self.device = device
+        self.entities = []
+        # State attributes common to every entity of the device, worked
+        # out once per update rather than by each entity
+        self.attributes = {}
+        self.refresh()
+
+    def refresh(self):
+        """Recompute the shared attributes from the device."""
+        self.attributes = {
+            ATTR_LAST_UPDATED: self.device.last_updated.isoformat(),
+        }
+
+    def async_push(self):
+        """Update and write the state of every entity whose source fields
+        changed in the last poll, without scheduling a task for each."""
+        changed = self.device.changed
+        if not changed:
+            return
+        self.refresh()
+        for entity in self.entities:
+            if changed.intersection(entity.source_fields):
+                entity.update()
+                # Entities not yet added to Home Assistant are written when added
+                if entity.hass is not None:
+                    entity.async_write_ha_state()
+
+
 class MyEnergiManager:
 
     SCAN_INTERVAL = timedelta(seconds=10)
-    back_off = 0
-    back_off_factor = 1.25
+    # Overall budget for one poll, including the ASN redirect and digest
+    # challenges; each HTTP attempt also has its own socket deadlines
+    FETCH_TIMEOUT = 15
+    # How often the snapshot used to restore entities at startup is saved
+    SNAPSHOT_INTERVAL = timedelta(minutes=5)
 
-    def __init__(self, hass, username, password):
+    def __init__(self, hass, username, password, metrics=None):
         self.hass = hass
-        self.hub = myenergi.Hub(username, password)
+        auth_cache = myenergi.AuthCache(hass.config.path('.storage', 'myenergi_auth'))
+        self.metrics = metrics if metrics is not None else myenergi.Metrics()
+        self.rolling_metrics = myenergi.RollingMetrics()
+        self.poll_scheduler = myenergi.PollScheduler(
+            interval=self.SCAN_INTERVAL.total_seconds())
+        self.hub = myenergi.Hub(username, password, auth_cache=auth_cache,
+                                metrics=self.metrics,
+                                rolling_metrics=self.rolling_metrics,
+                                poll_scheduler=self.poll_scheduler)
+        self.poll_interval = self.SCAN_INTERVAL
+        self.energy_meter = myenergi.EnergyMeter()
+        self._energy_sensors = None
+        self._energy_totals = None
+        self._rolling_sensors = None
+        self._rolling_updated = None
+        self._snapshot_file = myenergi.JsonFile(
+            hass.config.path('.storage', 'myenergi_snapshot_{}'.format(username)),
+            'snapshot')
+        self._snapshot = self._snapshot_file.load()
+        self._snapshot_due = None
         self._zappis_seen = {}
         self._harvis_seen = {}
         self.async_add_entities = self.async_add_entities_binary = None
@@ -72,93 +134,224 @@ class MyEnergiManager:
         self.async_add_entities = async_add_entities
 
     async def async_update_items(self):
-        new_zappi_sensors, new_zappi_binary_sensors = await self.async_update_zappis()
-        self.async_add_entities(new_zappi_sensors)
-        self.async_add_entities_binary(new_zappi_binary_sensors)
-        new_harvi_sensors, new_harvi_binary_sensors = await self.async_update_harvis()
-        self.async_add_entities(new_harvi_sensors)
-        self.async_add_entities_binary(new_harvi_binary_sensors)
-
-        # Removing items? uhhh. TODO
-
-    async def async_update_zappis(self):
-        all_new_sensors = []
-        all_new_binary_sensors = []
+        started = time.perf_counter()
         try:
-            with async_timeout.timeout(4):
-                zappis = await self.hub.async_fetch_zappis()
-        except (asyncio.TimeoutError, RequestException) as e:
+            async with async_timeout.timeout(self.FETCH_TIMEOUT):
+                devices = await self.hub.async_fetch_all()
+        except (asyncio.TimeoutError, aiohttp.ClientError, RequestException,
+                myenergi.ResponseError, myenergi.DecodeError,
+                myenergi.CircuitOpenError) as e:
+            self._record_backoff()
             if isinstance(e, asyncio.TimeoutError):
                 _LOGGER.error('Fetching devices timed out')
+            elif isinstance(e, myenergi.CircuitOpenError):
+                _LOGGER.debug('%s', e)
             else:
-                _LOGGER.error('Error while fetching Zappis: %s', e)
-            self.back_off += 1
-            _LOGGER.info('Backing off; will retry in %s seconds', round((
-                self.SCAN_INTERVAL * (1 + (self.back_off ** self.back_off_factor))
-            ).total_seconds(), 2))
-            return [], []
-
-        self.back_off = 0
+                _LOGGER.error('Error while fetching devices: %s', e)
+            _LOGGER.info('Backing off; will retry in %s seconds', round(
+                self._next_delay().total_seconds(), 2))
+            return
+
+        self.metrics.observe('myenergi_poll_seconds', time.perf_counter() - started,
+                             hub=str(self.hub))
+        self.poll_interval = timedelta(seconds=self.poll_scheduler.next_interval(
+            devices[myenergi.Zappi.device_map_key] + devices[myenergi.Harvi.device_map_key]))
+        self._record_backoff()
+        self.energy_meter.add_devices(
+            devices[myenergi.Zappi.device_map_key] + devices[myenergi.Harvi.device_map_key])
+        self._add_entities(devices)
+
+        if self._snapshot_due is None or utcnow() >= self._snapshot_due:
+            await self.async_save_snapshot()
+
+    def _add_entities(self, devices):
+        new_zappi_sensors, new_zappi_binary_sensors = self.update_zappis(
+            devices[myenergi.Zappi.device_map_key])
+        new_harvi_sensors, new_harvi_binary_sensors = self.update_harvis(
+            devices[myenergi.Harvi.device_map_key])
+        self.async_add_entities(
+            new_zappi_sensors + new_harvi_sensors + self.update_energy()
+            + self.update_rolling())
+        self.async_add_entities_binary(new_zappi_binary_sensors + new_harvi_binary_sensors)
+
+    def restore_snapshot(self):
+        """Create entities from the saved snapshot, if there is one, so they
+        have a state before the first poll. Returns True if anything was
+        restored."""
+        snapshot, self._snapshot = self._snapshot, None
+        if not snapshot:
+            return False
+        try:
+            devices = self.hub.restore(snapshot['devices'])
+            self.energy_meter.totals.update(snapshot['energy'])
+        except (KeyError, TypeError, ValueError) as e:
+            _LOGGER.warning('Ignoring invalid snapshot: %s', e)
+            return False
+        self._add_entities(devices)
+        _LOGGER.info('Restored %s devices from snapshot', sum(map(len, devices.values())))
+        return True
+
+    async def async_save_snapshot(self):
+        """Save the current devices and energy totals for the next start."""
+        self._snapshot_due = utcnow() + self.SNAPSHOT_INTERVAL
+        # Include readings still waiting to be integrated
+        self.energy_meter.flush()
+        snapshot = {
+            'devices': self.hub.snapshot(),
+            'energy': dict(self.energy_meter.totals),
+        }
+        await self.hass.async_add_executor_job(self._snapshot_file.save, snapshot)
+
+    def update_energy(self):
+        """Return the energy sensors the first time, and update them after."""
+        changed = self.energy_meter.totals != self._energy_totals
+        self._energy_totals = dict(self.energy_meter.totals)
+        if self._energy_sensors is None:
+            from .sensor import EnergySensor
+            self._energy_sensors = [
+                EnergySensor(self.hub, self.energy_meter, channel)
+                for channel in myenergi.EnergyMeter.channels
+            ]
+            return self._energy_sensors
+        if changed:
+            for s in self._energy_sensors:
+                s.update()
+                if s.hass is not None:
+                    s.async_write_ha_state()
+        return []
+
+    def update_rolling(self):
+        """Return the rolling power sensors the first time, and update them
+        after."""
+        self.rolling_metrics.flush()
+        changed = self.rolling_metrics.last_updated != self._rolling_updated
+        self._rolling_updated = self.rolling_metrics.last_updated
+        if self._rolling_sensors is None:
+            from .sensor import ROLLING_NAMES, RollingPowerSensor, SelfConsumptionSensor
+            windows = self.rolling_metrics.windows
+            self._rolling_sensors = [
+                RollingPowerSensor(self.hub, self.rolling_metrics, quantity, seconds)
+                for quantity in ROLLING_NAMES for seconds in windows
+            ] + [
+                SelfConsumptionSensor(self.hub, self.rolling_metrics, seconds)
+                for seconds in windows
+            ]
+            return self._rolling_sensors
+        if changed:
+            for s in self._rolling_sensors:
+                s.update()
+                if s.hass is not None:
+                    s.async_write_ha_state()
+        return []
+
+    def update_zappis(self, zappis):
+        all_new_sensors = []
+        all_new_binary_sensors = []
         from .binary_sensor import ZappiPresenceSensor
-        from .sensor import GenerationSensor, ZappiStatusSensor, ZappiPowerSensor
+        from .sensor import ZappiStatusSensor, ZappiPowerSensor
 
         for zappi in zappis:
             if zappi.serial in self._zappis_seen:
-                for s in self._zappis_seen[zappi.serial]:
-                    self.hass.async_create_task(s.async_update_ha_state(force_refresh=True))
+                coordinator = self._zappis_seen[zappi.serial]
+                all_new_sensors.extend(self._reconcile_generators(coordinator))
+                coordinator.async_push()
                 continue
             
+            coordinator = DeviceCoordinator(zappi)
             new_binary_sensors = [
-                ZappiPresenceSensor(zappi),
+                ZappiPresenceSensor(coordinator),
             ]
             new_sensors = [
-                ZappiStatusSensor(zappi),
-                ZappiPowerSensor(zappi),
+                ZappiStatusSensor(coordinator),
+                ZappiPowerSensor(coordinator),
             ]
-            new_sensors.extend([
-                GenerationSensor(zappi, i) for i in range(len(zappi.generators))
-            ])
-            self._zappis_seen[zappi.serial] = new_sensors + new_binary_sensors
+            coordinator.entities = new_sensors + new_binary_sensors
+            new_sensors.extend(self._reconcile_generators(coordinator))
+            self._zappis_seen[zappi.serial] = coordinator
 
             all_new_sensors.extend(new_sensors)
             all_new_binary_sensors.extend(new_binary_sensors)
 
+        self._retire_vanished(self._zappis_seen, zappis)
         return all_new_sensors, all_new_binary_sensors
 
-    async def async_update_harvis(self):
+    def update_harvis(self, harvis):
         all_new_sensors = []
-        try:
-            with async_timeout.timeout(4):
-                harvis = await self.hub.async_fetch_harvis()
-        except (asyncio.TimeoutError, RequestException) as e:
-            if isinstance(e, asyncio.TimeoutError):
-                _LOGGER.error('Fetching devices timed out')
-            else:
-                _LOGGER.error('Error while fetching Harvis: %s', e)
-            self.back_off += 1
-            _LOGGER.info('Backing off; will retry in %s seconds', round((
-                self.SCAN_INTERVAL * (1 + (self.back_off ** self.back_off_factor))
-            ).total_seconds(), 2))
-            return [], []
-
-        self.back_off = 0
-        from .sensor import GenerationSensor
 
         for harvi in harvis:
             if harvi.serial in self._harvis_seen:
-                for s in self._harvis_seen[harvi.serial]:
-                    self.hass.async_create_task(s.async_update_ha_state(force_refresh=True))
+                coordinator = self._harvis_seen[harvi.serial]
+                all_new_sensors.extend(self._reconcile_generators(coordinator))
+                coordinator.async_push()
                 continue
             
-            new_sensors = [
-                GenerationSensor(harvi, i) for i in range(len(harvi.generators))
-            ]
-            self._harvis_seen[harvi.serial] = new_sensors
-
-            all_new_sensors.extend(new_sensors)
+            coordinator = DeviceCoordinator(harvi)
+            all_new_sensors.extend(self._reconcile_generators(coordinator))
+            self._harvis_seen[harvi.serial] = coordinator
 
+        self._retire_vanished(self._harvis_seen, harvis)
         return all_new_sensors, []
 
+    def _reconcile_generators(self, coordinator):
+        """Match a device's generation sensors to its current CT clamps,
+        retiring sensors for clamps that have gone or changed type. Returns
+        the sensors for any new clamps, to be added."""
+        from .sensor import GenerationSensor
+
+        device = coordinator.device
+        wanted = {(g.slot, g.type) for g in device.generators}
+        entities = []
+        # Including sensors being retired, whose removal is still pending
+        unique_ids = set()
+        for entity in coordinator.entities:
+            if isinstance(entity, GenerationSensor):
+                unique_ids.add(entity.unique_id)
+                if entity.generator_key not in wanted:
+                    self._retire(entity)
+                    continue
+                wanted.discard(entity.generator_key)
+            entities.append(entity)
+        new_sensors = []
+        for slot, _ in sorted(wanted):
+            # The lowest slot of each type keeps the name as its unique ID,
+            # as before clamps were told apart by slot
+            sensor = GenerationSensor(coordinator, slot)
+            if sensor.unique_id in unique_ids:
+                sensor = GenerationSensor(coordinator, slot, with_slot=True)
+            unique_ids.add(sensor.unique_id)
+            new_sensors.append(sensor)
+        coordinator.entities = entities + new_sensors
+        return new_sensors
+
+    def _retire_vanished(self, seen, devices):
+        """Retire the entities of devices the hub no longer reports."""
+        serials = {d.serial for d in devices}
+        for serial in [s for s in seen if s not in serials]:
+            coordinator = seen.pop(serial)
+            _LOGGER.info('Removing entities for %s, no longer reported', coordinator.device)
+            for entity in coordinator.entities:
+                self._retire(entity)
+
+    def _retire(self, entity):
+        # Entities never added to Home Assistant only need forgetting
+        if entity.hass is not None:
+            self.hass.async_create_task(entity.async_remove())
+
+    def _record_backoff(self):
+        breaker = self.hub.circuit_breaker
+        self.metrics.set_gauge('myenergi_poll_delay_seconds',
+                               self._next_delay().total_seconds(), hub=str(self.hub))
+        self.metrics.set_gauge('myenergi_circuit_open',
+                               int(breaker.state != breaker.CLOSED), host=breaker.host)
+        self.metrics.set_gauge('myenergi_circuit_failures', breaker.failures,
+                               host=breaker.host)
+
+    def _next_delay(self):
+        retry_after = self.hub.circuit_breaker.retry_after
+        if retry_after:
+            return max(self.SCAN_INTERVAL, timedelta(seconds=retry_after))
+        return self.poll_interval
+
     async def start(self):
         """Start updating sensors from the hub on a schedule."""
         # but only if it's not already started, and when we've got the
@@ -167,28 +360,60 @@ class MyEnergiManager:
             return
 
         self._started = True
+
+        async def async_stop(event):
+            await self.async_save_snapshot()
+            await self.hub.protocol.auth_cache.async_save()
+            await self.hub.async_close()
+
+        self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop)
         _LOGGER.info(
-            "Starting MyEnergi polling loop with %s second interval",
-            self.SCAN_INTERVAL.total_seconds(),
+            "Starting MyEnergi polling loop with %s-%s second interval",
+            self.poll_scheduler.min_interval,
+            self.poll_scheduler.max_interval,
         )
 
         async def async_update(now):
             """Will update data."""
 
-            await self.async_update_items()
+            try:
+                await self.async_update_items()
+            finally:
+                # Keep polling whatever went wrong with this update
+                async_track_point_in_utc_time(
+                    self.hass, async_update, utcnow() + self._next_delay()
+                )
+
+        if self.restore_snapshot():
+            # Entities already exist, so don't hold up setup for the poll
+            self.hass.async_create_task(async_update(None))
+        else:
+            await async_update(None)
+
+
+class MyEnergiMetricsView(HomeAssistantView):
+    """Serves request metrics in the Prometheus text format."""
+
+    url = '/api/myenergi/metrics'
+    name = 'api:myenergi:metrics'
 
-            async_track_point_in_utc_time(
-                self.hass, async_update, utcnow() + (self.SCAN_INTERVAL * (1 + (self.back_off ** self.back_off_factor)))
-            )
+    def __init__(self, metrics):
+        """Initialize the view."""
+        self.metrics = metrics
 
-        await async_update(None)
+    async def get(self, request):
+        """Return the metrics."""
+        return web.Response(text=self.metrics.to_prometheus(),
+                            content_type='text/plain')
 
 
 def setup(hass, config):
     """Set up MyEnergi devices."""
     hass.data[DOMAIN] = {}
     device_info = config.get(DOMAIN, {})
-    hass.data[DOMAIN][device_info[CONF_USERNAME]] = MyEnergiManager(hass, device_info[CONF_USERNAME], device_info[CONF_PASSWORD])
+    metrics = myenergi.Metrics()
+    hass.data[DOMAIN][device_info[CONF_USERNAME]] = MyEnergiManager(hass, device_info[CONF_USERNAME], device_info[CONF_PASSWORD], metrics)
+    hass.http.register_view(MyEnergiMetricsView(metrics))
     device_info = dict(device_info)
     device_info.pop(CONF_PASSWORD)
     discovery.load_platform(hass, 'binary_sensor', DOMAIN, device_info, config)
@@ -1,10 +1,12 @@
 """Support for MyEnergi sensors."""
 import logging
 
-from homeassistant.const import CONF_USERNAME, DEVICE_CLASS_POWER, POWER_WATT
+from homeassistant.const import (
+    CONF_USERNAME, DEVICE_CLASS_ENERGY, DEVICE_CLASS_POWER, ENERGY_KILO_WATT_HOUR,
+    PERCENTAGE, POWER_WATT)
 from homeassistant.helpers.entity import Entity
 
-from .platform import ATTR_LAST_UPDATED, ATTR_MODE, ATTR_MODE_ECO, ATTR_MODE_ECO_PLUS, ATTR_MODE_FAST, ATTR_POWER, ATTR_VOLTAGE, DOMAIN, STATE_BOOSTING, STATE_CHARGING, STATE_COMPLETE, STATE_DELAYED, STATE_EV_WAITING, STATE_FAULT, STATE_NOT_CONNECTED, STATE_WAITING
+from .platform import ATTR_EWMA, ATTR_MAXIMUM, ATTR_MINIMUM, ATTR_MODE, ATTR_MODE_ECO, ATTR_MODE_ECO_PLUS, ATTR_MODE_FAST, ATTR_POWER, ATTR_SAMPLES, ATTR_VOLTAGE, DOMAIN, STATE_BOOSTING, STATE_CHARGING, STATE_COMPLETE, STATE_DELAYED, STATE_EV_WAITING, STATE_FAULT, STATE_NOT_CONNECTED, STATE_WAITING
 from .myenergi import DeviceType, ZappiMode, ZappiStatus
 
 _LOGGER = logging.getLogger(__name__)
@@ -41,9 +43,13 @@ MODE_MAP = {
 class ZappiStatusSensor(Entity):
     """The entity class for the Zappi charging station status."""
 
-    def __init__(self, zappi):
+    # Device fields this entity's state and attributes are built from
+    source_fields = ('status', 'mode', 'power', 'voltage')
+
+    def __init__(self, coordinator):
         """Initialize the Zappi Sensor."""
-        self._device = zappi
+        self._coordinator = coordinator
+        self._device = coordinator.device
         self._name = self._device.name
         self._icon = 'mdi:power-plug'
         self._state = None
@@ -118,8 +124,8 @@ class ZappiStatusSensor(Entity):
             ATTR_MODE: MODE_MAP.get(self._device.mode, ATTR_MODE_ECO),
             ATTR_POWER: self._device.power,
             ATTR_VOLTAGE: self._device.voltage,
-            ATTR_LAST_UPDATED: self._device.last_updated.isoformat(),
         }
+        self._attributes.update(self._coordinator.attributes)
 
 
 POWER_ICONS = {
@@ -134,10 +140,11 @@ class PowerSensorBase(Entity):
 
     state_class = "measurement"
 
-    def __init__(self, device):
+    def __init__(self, coordinator):
         self._icon = None
         self._name = None
-        self._device = device
+        self._coordinator = coordinator
+        self._device = coordinator.device
         self._unit = POWER_WATT
         self._device_class = DEVICE_CLASS_POWER
         self.update()
@@ -194,19 +201,33 @@ class PowerSensorBase(Entity):
         """Return the state attributes of the binary sensor."""
         return self._attributes
 
-    def update(self):
-        """Get latest cached states from the device."""
-        self._state = self._device.generators[self._generator_index]['power']
-        self._attributes = {ATTR_LAST_UPDATED: self._device.last_updated.isoformat()}
-
 
 class GenerationSensor(PowerSensorBase):
     """The entity class for a generation source."""
 
-    def __init__(self, device, generator_index):
-        self._generator_index = generator_index
-        self._device_type = device.generators[self._generator_index]['type']
-        PowerSensorBase.__init__(self, device)
+    source_fields = ('generators',)
+
+    def __init__(self, coordinator, slot, with_slot=False):
+        self._slot = slot
+        self._device_type = coordinator.device.generator(slot).type
+        # Only sensors for a second clamp of the same type need the slot
+        # in their unique ID; the others keep the ID they always had
+        self._with_slot = with_slot
+        PowerSensorBase.__init__(self, coordinator)
+
+    @property
+    def generator_key(self):
+        """The CT slot and type this sensor reports on."""
+        return self._slot, self._device_type
+
+    @property
+    def unique_id(self):
+        """Return the unique ID of the sensor, which differs when a clamp
+        changes type, and with ``with_slot``, between clamps of the same
+        type."""
+        if self._with_slot:
+            return '{}_ct{}_{}'.format(self._device, self._slot, self._device_type.value)
+        return self.name
 
     @property
     def name(self):
@@ -217,11 +238,24 @@ class GenerationSensor(PowerSensorBase):
             self._name = '{} {} power from {}'.format(device_type_title, str(self._device), generator_type_title)
         return self._name
 
+    def update(self):
+        """Get latest cached states from the device."""
+        generator = self._device.generator(self._slot)
+        # Until the manager retires it, a sensor whose CT has gone or
+        # changed type has no state
+        if generator is None or generator.type is not self._device_type:
+            self._state = None
+        else:
+            self._state = generator.power
+        # Shared with the device's other entities; not to be modified
+        self._attributes = self._coordinator.attributes
+
 
 class ZappiPowerSensor(PowerSensorBase):
     """The entity class for a Zappi charging station power."""
 
     _device_type = DeviceType.ZAPPI
+    source_fields = ('power', 'status')
 
     @property
     def name(self):
@@ -238,6 +272,199 @@ class ZappiPowerSensor(PowerSensorBase):
     def update(self):
         """Get latest cached states from the device."""
         self._state = self._device.power
+        self._attributes = self._coordinator.attributes
+
+ENERGY_NAMES = {
+    'grid_import': 'grid import',
+    'grid_export': 'grid export',
+    'solar': 'solar generation',
+    'ev': 'EV charging',
+    'home': 'home consumption',
+}
+
+ENERGY_ICONS = {
+    'grid_import': 'mdi:transmission-tower-import',
+    'grid_export': 'mdi:transmission-tower-export',
+    'solar': 'mdi:solar-power',
+    'ev': 'mdi:car-electric',
+    'home': 'mdi:home-lightning-bolt',
+}
+
+
+class EnergySensor(Entity):
+    """The entity class for a hub's cumulative energy counter."""
+
+    state_class = "total_increasing"
+    source_fields = ()
+
+    def __init__(self, hub, meter, channel):
+        self._hub = hub
+        self._meter = meter
+        self._channel = channel
+        self._name = 'MyEnergi {} {} energy'.format(hub, ENERGY_NAMES[channel])
+        self._state = None
+        self.update()
+
+    @property
+    def should_poll(self):
+        """Deactivate polling. Data updated by hub."""
+        return False
+
+    @property
+    def unique_id(self):
+        """Return the unique ID of the sensor."""
+        return self._name
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def icon(self):
+        """Icon to use in the frontend, if any."""
+        return ENERGY_ICONS[self._channel]
+
+    @property
+    def device_class(self):
+        """Return the class of this sensor."""
+        return DEVICE_CLASS_ENERGY
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def unit_of_measurement(self):
+        """Get the unit of measurement."""
+        return ENERGY_KILO_WATT_HOUR
+
+    def update(self):
+        """Get the latest totals from the energy meter."""
+        self._state = round(self._meter.totals[self._channel], 3)
+
+
+ROLLING_NAMES = {
+    'grid': 'grid',
+    'solar': 'solar generation',
+    'ev': 'EV charging',
+    'surplus': 'solar surplus',
+}
+
+ROLLING_ICONS = {
+    'grid': 'mdi:transmission-tower',
+    'solar': 'mdi:solar-power',
+    'ev': 'mdi:car-electric',
+    'surplus': 'mdi:solar-power-variant',
+}
+
+
+def _round(value, digits=None):
+    return None if value is None else round(value, digits)
+
+
+class RollingSensorBase(Entity):
+    """Base class for a hub's sensors over a rolling window."""
+
+    state_class = "measurement"
+    source_fields = ()
+
+    def __init__(self, hub, rolling_metrics, seconds, name):
+        self._hub = hub
+        self._rolling_metrics = rolling_metrics
+        self._seconds = seconds
+        self._name = 'MyEnergi {} {} {} min'.format(hub, name, seconds // 60)
+        self._state = None
+        self._attributes = {}
+        self.update()
+
+    @property
+    def should_poll(self):
+        """Deactivate polling. Data updated by hub."""
+        return False
+
+    @property
+    def unique_id(self):
+        """Return the unique ID of the sensor."""
+        return self._name
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def extra_state_attributes(self):
+        """Return the state attributes of the sensor."""
+        return self._attributes
+
+
+class RollingPowerSensor(RollingSensorBase):
+    """The entity class for a hub's mean power over a rolling window, with
+    the moving average, minimum and maximum as attributes."""
+
+    def __init__(self, hub, rolling_metrics, quantity, seconds):
+        self._quantity = quantity
+        RollingSensorBase.__init__(self, hub, rolling_metrics, seconds,
+                                   '{} power'.format(ROLLING_NAMES[quantity]))
+
+    @property
+    def icon(self):
+        """Icon to use in the frontend, if any."""
+        return ROLLING_ICONS[self._quantity]
+
+    @property
+    def device_class(self):
+        """Return the class of this sensor."""
+        return DEVICE_CLASS_POWER
+
+    @property
+    def unit_of_measurement(self):
+        """Get the unit of measurement."""
+        return POWER_WATT
+
+    def update(self):
+        """Get the latest statistics from the rolling window."""
+        window = self._rolling_metrics.window(self._quantity, self._seconds)
+        self._state = _round(window.mean)
         self._attributes = {
-            ATTR_LAST_UPDATED: self._device.last_updated.isoformat(),
-        }
\ No newline at end of file
+            ATTR_EWMA: _round(window.ewma),
+            ATTR_MINIMUM: window.minimum,
+            ATTR_MAXIMUM: window.maximum,
+            ATTR_SAMPLES: len(window),
+        }
+
+
+class SelfConsumptionSensor(RollingSensorBase):
+    """The entity class for the share of a hub's solar generation used on
+    site over a rolling window."""
+
+    def __init__(self, hub, rolling_metrics, seconds):
+        RollingSensorBase.__init__(self, hub, rolling_metrics, seconds,
+                                   'solar self-consumption')
+
+    @property
+    def icon(self):
+        """Icon to use in the frontend, if any."""
+        return 'mdi:home-percent'
+
+    @property
+    def device_class(self):
+        """Return the class of this sensor."""
+        return None
+
+    @property
+    def unit_of_measurement(self):
+        """Get the unit of measurement."""
+        return PERCENTAGE
+
+    def update(self):
+        """Get the latest ratio from the rolling windows."""
+        ratio = self._rolling_metrics.self_consumption(self._seconds)
+        self._state = None if ratio is None else round(ratio * 100, 1)
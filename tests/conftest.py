@@ -0,0 +1,10 @@
+"""Put tools/ on ``sys.path``, for ``_loader`` and ``mock_director``.
+
+Run the tests from this directory, or with the ``pytest`` script, rather
+than with ``python -m pytest`` from the repository root; see
+tools/_loader.py for why.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
@@ -0,0 +1,74 @@
+"""Tests for AuthCache and the JsonFile it is kept in."""
+import asyncio
+import json
+import threading
+
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_changes_are_saved_after_a_delay(tmp_path):
+    path = tmp_path / 'auth.json'
+    cache = myenergi.AuthCache(str(path))
+    cache.save_delay = 0.01
+
+    async def run():
+        for n in range(10):
+            cache.set(1, {'asn': 'asn{}'.format(n)})
+        assert not path.exists()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert _load(path) == {'1': {'asn': 'asn9'}}
+    assert myenergi.AuthCache(str(path)).get(1) == {'asn': 'asn9'}
+
+
+def test_async_save_writes_straight_away(tmp_path):
+    path = tmp_path / 'auth.json'
+    cache = myenergi.AuthCache(str(path))
+    cache.save_delay = 60
+
+    async def run():
+        cache.set(1, {'asn': 'a'})
+        await cache.async_save()
+        assert _load(path) == {'1': {'asn': 'a'}}
+        assert cache._save_handle is None
+
+    asyncio.run(run())
+
+
+def test_async_save_waits_for_a_delayed_write(tmp_path):
+    path = tmp_path / 'auth.json'
+    cache = myenergi.AuthCache(str(path))
+    cache.save_delay = 0
+
+    async def run():
+        cache.set(1, {'asn': 'a'})
+        # Let the delayed write start, then change the entry again
+        await asyncio.sleep(0)
+        cache.set(1, {'asn': 'b'})
+        await cache.async_save()
+
+    asyncio.run(run())
+    assert _load(path) == {'1': {'asn': 'b'}}
+
+
+def test_concurrent_saves_do_not_mix(tmp_path):
+    path = tmp_path / 'data.json'
+    json_file = myenergi.JsonFile(str(path))
+    threads = [
+        threading.Thread(target=json_file.save, args=({'n': n, 'pad': 'x' * 100000},))
+        for n in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert _load(path)['n'] in range(8)
+    assert [p.name for p in tmp_path.iterdir()] == ['data.json']
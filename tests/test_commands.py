@@ -0,0 +1,44 @@
+"""Tests for Zappi commands, against the mock director without sockets."""
+import asyncio
+
+import mock_director
+import pytest
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+
+@pytest.fixture
+def director():
+    return mock_director.MockDirector(hubs=1, port=1, asn_port=2,
+                                      command_delay=0, seed=1)
+
+
+def _hub(director):
+    hub = myenergi.Hub(mock_director.FIRST_HUB_SERIAL, 'password',
+                       director=director.url,
+                       transport=mock_director.MockTransport(director))
+    hub.commands.min_poll_delay = 0.01
+    hub.commands.settle_time = 0
+    return hub
+
+
+def test_poll_after_command_reports_the_change(director):
+    async def run():
+        hub = _hub(director)
+        try:
+            zappi, = (await hub.async_fetch_all())[myenergi.Zappi.device_map_key]
+            assert zappi.mode is myenergi.ZappiMode.ECO
+            status = await zappi.async_set_mode(myenergi.ZappiMode.FAST)
+            assert status is myenergi.CommandStatus.FINISHED
+            # The queue's own polls saw the new mode first, but didn't
+            # report it, so the next regular poll does
+            await hub.async_fetch_all()
+            assert zappi.mode is myenergi.ZappiMode.FAST
+            assert 'mode' in zappi.changed
+            await hub.async_fetch_all()
+            assert 'mode' not in zappi.changed
+        finally:
+            await hub.async_close()
+
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+"""Tests for EnergyMeter, with and without NumPy."""
+import random
+
+import pytest
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def meter(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(myenergi, 'numpy', None)
+    return myenergi.EnergyMeter(batch_size=1000)
+
+
+def test_constant_power(meter):
+    for t in range(0, 3601, 10):
+        meter.add_sample(t, grid=1000.0, solar=500.0, ev=200.0)
+    meter.flush()
+    assert meter.totals['grid_import'] == pytest.approx(1.0)
+    assert meter.totals['grid_export'] == 0
+    assert meter.totals['solar'] == pytest.approx(0.5)
+    assert meter.totals['ev'] == pytest.approx(0.2)
+    assert meter.totals['home'] == pytest.approx(1.3)
+
+
+def test_gaps_are_not_counted(meter):
+    meter.add_sample(0, grid=1000.0)
+    meter.add_sample(60, grid=1000.0)
+    meter.add_sample(60 + meter.max_gap + 1, grid=1000.0)
+    meter.flush()
+    assert meter.totals['grid_import'] == pytest.approx(1000 * 60 / 3.6e6)
+
+
+def test_older_readings_are_dropped(meter):
+    meter.add_sample(100, grid=1000.0)
+    meter.flush()
+    meter.add_sample(50, grid=1000.0)
+    meter.add_sample(110, grid=1000.0)
+    meter.flush()
+    assert meter.dropped == 1
+    assert meter.totals['grid_import'] == pytest.approx(1000 * 10 / 3.6e6)
+
+
+def _samples():
+    rng = random.Random(1)
+    samples = []
+    for n in range(400):
+        # Every time appears twice, with different readings
+        t = float(n // 2 * 10)
+        samples.append((t, rng.uniform(-3000, 3000), rng.uniform(0, 4000),
+                        rng.uniform(-1000, 1000), rng.uniform(0, 7000)))
+    rng.shuffle(samples)
+    return samples
+
+
+def test_numpy_and_python_agree(monkeypatch):
+    pytest.importorskip('numpy')
+    totals = []
+    for numpy in (myenergi.numpy, None):
+        monkeypatch.setattr(myenergi, 'numpy', numpy)
+        meter = myenergi.EnergyMeter(batch_size=150)
+        for sample in _samples():
+            meter.add_sample(*sample)
+        meter.flush()
+        totals.append((meter.totals, meter.dropped))
+    (numpy_totals, numpy_dropped), (python_totals, python_dropped) = totals
+    assert python_dropped == numpy_dropped
+    assert python_totals == pytest.approx(numpy_totals)
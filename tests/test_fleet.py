@@ -0,0 +1,93 @@
+"""Tests for Fleet, against the mock director without sockets."""
+import asyncio
+
+import mock_director
+import pytest
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+
+@pytest.fixture
+def director():
+    return mock_director.MockDirector(hubs=2, port=1, asn_port=2, seed=1)
+
+
+def _fleet(director, **kwargs):
+    fleet = myenergi.Fleet(interval=0.01, director=director.url,
+                           transport=mock_director.MockTransport(director),
+                           **kwargs)
+    for serial in director.hubs:
+        fleet.add_hub(serial, 'password')
+    return fleet
+
+
+async def _run_until(fleet, polls, serial, timeout=5):
+    done = asyncio.Event()
+
+    async def on_poll(hub, result):
+        if hub.serial == serial:
+            polls.append(result)
+            if len(polls) >= 10:
+                done.set()
+            if len(polls) == 1:
+                raise RuntimeError('on_poll failed')
+
+    fleet.on_poll = on_poll
+    await fleet.async_start()
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    finally:
+        await fleet.async_stop()
+
+
+def test_unexpected_errors_do_not_stop_polling(director):
+    serial = mock_director.FIRST_HUB_SERIAL
+    zappi, = director.hubs[serial].zappis.values()
+    to_json = zappi.to_json
+    calls = []
+
+    def partial_to_json(now):
+        data = to_json(now)
+        calls.append(data)
+        if len(calls) == 1:
+            del data['frq']
+        return data
+
+    zappi.to_json = partial_to_json
+    fleet = _fleet(director)
+    polls = []
+    asyncio.run(_run_until(fleet, polls, serial))
+    # The partial status and the failing on_poll each cost one poll only
+    assert len(polls) >= 10
+    assert serial not in fleet.errors
+
+
+def test_partial_status_is_recorded_as_an_error(director):
+    serial = mock_director.FIRST_HUB_SERIAL
+    zappi, = director.hubs[serial].zappis.values()
+    zappi.to_json = lambda now: {'sno': zappi.serial}
+    fleet = _fleet(director)
+
+    async def run():
+        try:
+            await fleet.async_poll_all()
+        finally:
+            await fleet.async_stop()
+
+    asyncio.run(run())
+    assert isinstance(fleet.errors[serial], KeyError)
+    assert serial + 1 in fleet.results
+
+
+def test_hubs_make_no_requests_session(director):
+    fleet = _fleet(director)
+
+    async def run():
+        try:
+            await fleet.async_poll_all()
+        finally:
+            await fleet.async_stop()
+
+    asyncio.run(run())
+    assert all(hub._session is None for hub in fleet.hubs.values())
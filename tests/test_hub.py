@@ -0,0 +1,52 @@
+"""Tests for Hub requests, against the mock director without sockets."""
+import asyncio
+import datetime
+
+import mock_director
+import pytest
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+
+@pytest.fixture
+def hub():
+    director = mock_director.MockDirector(hubs=1, port=1, asn_port=2, seed=1)
+    return myenergi.Hub(mock_director.FIRST_HUB_SERIAL, 'password',
+                        director=director.url,
+                        transport=mock_director.MockTransport(director))
+
+
+def test_identical_requests_are_coalesced(hub):
+    async def run():
+        try:
+            return await asyncio.gather(
+                hub.async_request(*myenergi.status_call()),
+                hub.async_request(*myenergi.status_call()))
+        finally:
+            await hub.async_close()
+
+    first, second = asyncio.run(run())
+    assert first is second
+    assert hub.request_stats.coalesced == 1
+
+
+def test_parsed_and_plain_requests_are_not_shared(hub):
+    day = datetime.date(2026, 1, 1)
+
+    async def run():
+        try:
+            zappi, = (await hub.async_fetch_all())[myenergi.Zappi.device_map_key]
+            call = myenergi.history_call(zappi, day)
+            return await asyncio.gather(
+                hub.async_request(*call),
+                hub.async_request(*call, parser=myenergi.HistoryParser(day)),
+                hub.async_request(*call, parser=myenergi.HistoryParser(day)))
+        finally:
+            await hub.async_close()
+
+    plain, parsed, parsed_again = asyncio.run(run())
+    assert isinstance(plain, dict)
+    assert isinstance(parsed, myenergi.HistoryDay)
+    assert parsed_again is parsed
+    assert hub.request_stats.coalesced == 1
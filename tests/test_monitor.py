@@ -0,0 +1,50 @@
+"""Tests for Monitor, against the mock director without sockets."""
+import asyncio
+import json
+import os
+
+import mock_director
+import pytest
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+
+def _poll_once(output):
+    director = mock_director.MockDirector(hubs=1, port=1, asn_port=2, seed=1)
+    fleet = myenergi.Fleet(director=director.url,
+                           transport=mock_director.MockTransport(director))
+    fleet.add_hub(mock_director.FIRST_HUB_SERIAL, 'password')
+    monitor = myenergi.Monitor(fleet, output)
+
+    async def run():
+        await monitor.async_start()
+        try:
+            await fleet.async_poll_all()
+        finally:
+            await fleet.async_stop()
+            await monitor.async_stop()
+
+    asyncio.run(run())
+    return monitor
+
+
+def test_terminal_is_left_blocking():
+    pty = pytest.importorskip('pty')
+    master, slave = pty.openpty()
+    with os.fdopen(slave, 'w') as output:
+        monitor = _poll_once(output)
+        assert os.get_blocking(slave)
+    os.close(master)
+    assert monitor.written == 2
+
+
+def test_pipe_is_left_blocking():
+    read, write = os.pipe()
+    with os.fdopen(write, 'w') as output, os.fdopen(read, 'rb') as reader:
+        monitor = _poll_once(output)
+        assert os.get_blocking(write)
+        output.close()
+        lines = reader.read().splitlines()
+    assert len(lines) == monitor.written == 2
+    assert {json.loads(line)['device'] for line in lines} == {'Z110', 'H150'}
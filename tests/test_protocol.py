@@ -0,0 +1,151 @@
+"""Tests for the sans-IO director protocol, without any sockets."""
+import types
+
+import mock_director
+import pytest
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+DIRECTOR = 'https://director.test'
+ASN = 's18.myenergi.test'
+CHALLENGE = 'Digest realm="MyEnergi Telemetry", qop="auth", nonce="{}", opaque="x"'
+
+
+def _response(status, headers=None, body=b''):
+    return myenergi.Response(status, headers or {}, body, len(body))
+
+
+@pytest.fixture
+def protocol():
+    return myenergi.HubProtocol(12345678, 'password', director=DIRECTOR)
+
+
+def test_asn_redirect(protocol):
+    request = protocol.request(myenergi.status_call())
+    assert request.host == 'director.test'
+    assert protocol.receive(request, _response(401, {'x_myenergi-asn': ASN}))
+    retry = protocol.request(myenergi.status_call())
+    assert retry.host == ASN
+    assert retry.url.startswith('https://{}/cgi-jstatus-'.format(ASN))
+
+
+def test_redirect_to_same_asn_is_not_retried(protocol):
+    protocol.asn = ASN
+    request = protocol.request(myenergi.status_call())
+    with pytest.raises(myenergi.ResponseError):
+        protocol.receive(request, _response(401, {'x_myenergi-asn': ASN}))
+
+
+def test_new_challenge_is_answered(protocol):
+    request = protocol.request(myenergi.status_call())
+    assert 'Authorization' not in request.headers
+    headers = {'WWW-Authenticate': CHALLENGE.format('abc')}
+    assert protocol.receive(request, _response(401, headers))
+    retry = protocol.request(myenergi.status_call())
+    assert retry.headers['Authorization'].startswith('Digest ')
+    assert 'nonce="abc"' in retry.headers['Authorization']
+
+
+def test_repeated_nonce_fails(protocol):
+    headers = {'WWW-Authenticate': CHALLENGE.format('abc')}
+    assert protocol.receive(protocol.request(myenergi.status_call()), _response(401, headers))
+    # The same nonce again means the answer to it was rejected
+    request = protocol.request(myenergi.status_call())
+    with pytest.raises(myenergi.ResponseError) as e:
+        protocol.receive(request, _response(401, headers), attempt=1)
+    assert e.value.status == 401
+
+
+def test_stale_nonce_is_retried(protocol):
+    headers = {'WWW-Authenticate': CHALLENGE.format('abc')}
+    assert protocol.receive(protocol.request(myenergi.status_call()), _response(401, headers))
+    stale = {'WWW-Authenticate': CHALLENGE.format('abc') + ', stale=true'}
+    request = protocol.request(myenergi.status_call())
+    assert protocol.receive(request, _response(401, stale), attempt=1)
+
+
+def test_attempts_are_bounded(protocol):
+    last = protocol.max_request_attempts - 1
+    request = protocol.request(myenergi.status_call())
+    headers = {'WWW-Authenticate': CHALLENGE.format('abc')}
+    with pytest.raises(myenergi.ResponseError):
+        protocol.receive(request, _response(401, headers), attempt=last)
+
+
+def test_error_status_raises(protocol):
+    request = protocol.request(myenergi.status_call())
+    with pytest.raises(myenergi.ResponseError) as e:
+        protocol.receive(request, _response(500))
+    assert e.value.status == 500
+
+
+def test_success_is_decoded(protocol):
+    request = protocol.request(myenergi.status_call())
+    response = _response(200, body=b'[{"zappi": []}]')
+    assert not protocol.receive(request, response)
+    assert protocol.decode(response) == [{'zappi': []}]
+
+
+def test_invalid_body_raises_decode_error(protocol):
+    with pytest.raises(myenergi.DecodeError):
+        protocol.decode(_response(200, body=b'<html>'))
+
+
+def _signed_request(auth, path):
+    return types.SimpleNamespace(
+        method='GET', path_qs=path,
+        headers={'Authorization': auth.authorization('GET', path)})
+
+
+@pytest.fixture
+def director():
+    return mock_director.MockDirector(hubs=1, password='secret', seed=1)
+
+
+def test_digest_authorization_is_accepted(director):
+    serial = mock_director.FIRST_HUB_SERIAL
+    auth = myenergi.DigestAuth(str(serial), 'secret')
+    assert auth.handle_challenge(director._challenge().headers['WWW-Authenticate'])
+    path = '/cgi-jstatus-*'
+    assert director._authenticate(_signed_request(auth, path)) is director.hubs[serial]
+    # Each request counts up the nonce count, and is still accepted
+    assert director._authenticate(_signed_request(auth, path)) is director.hubs[serial]
+
+
+def test_digest_authorization_with_wrong_password_is_rejected(director):
+    auth = myenergi.DigestAuth(str(mock_director.FIRST_HUB_SERIAL), 'wrong')
+    auth.handle_challenge(director._challenge().headers['WWW-Authenticate'])
+    response = director._authenticate(_signed_request(auth, '/cgi-jstatus-*'))
+    assert response.status == 401
+
+
+def test_digest_authorization_after_nonce_expires(director):
+    auth = myenergi.DigestAuth(str(mock_director.FIRST_HUB_SERIAL), 'secret')
+    auth.handle_challenge(director._challenge().headers['WWW-Authenticate'])
+    director._nonce = None
+    response = director._authenticate(_signed_request(auth, '/cgi-jstatus-*'))
+    assert response.status == 401
+    challenge = response.headers['WWW-Authenticate']
+    assert 'stale=true' in challenge
+    assert auth.handle_challenge(challenge)
+    request = _signed_request(auth, '/cgi-jstatus-*')
+    assert director._authenticate(request) is director.hubs[mock_director.FIRST_HUB_SERIAL]
+
+
+def test_status_items_unfiltered():
+    response = [
+        {'eddi': []},
+        {'zappi': [{'sno': 1}, {'sno': 2}]},
+        {'harvi': [{'sno': 3}]},
+        {'asn': ASN, 'fwv': '3401S3.077'},
+    ]
+    assert myenergi.status_items(response) == {
+        'eddi': [],
+        'zappi': [{'sno': 1}, {'sno': 2}],
+        'harvi': [{'sno': 3}],
+    }
+
+
+def test_status_items_filtered():
+    assert myenergi.status_items({'zappi': [{'sno': 1}]}) == {'zappi': [{'sno': 1}]}
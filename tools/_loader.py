@@ -0,0 +1,23 @@
+"""Load myenergi.py by its file path.
+
+The tools, benchmarks and tests can't simply put the repository root on
+``sys.path`` and import myenergi from there, as ``platform.py`` in the
+root would then shadow the standard library module of the same name.
+They put this directory on ``sys.path`` instead and use ``load_myenergi``.
+"""
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_myenergi():
+    """Import myenergi.py from the repository root, once, and return it."""
+    if 'myenergi' not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            'myenergi', os.path.join(ROOT, 'myenergi.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['myenergi'] = module
+        spec.loader.exec_module(module)
+    return sys.modules['myenergi']
@@ -0,0 +1,396 @@
+"""A local stand-in for the MyEnergi director and ASN servers.
+
+Serves a synthetic fleet of hubs, each with some Zappis and Harvis, behind
+digest authentication and the same ``x_myenergi-asn`` redirect as the real
+director. Latency and server errors can be injected to exercise retries
+and back-off.
+
+Run it with::
+
+    python tools/mock_director.py --hubs 100 --zappis 1 --harvis 1
+
+then point a hub at it with ``Hub(serial, 'password',
+director='http://127.0.0.1:<port>')``. Hub serials start at 10000001.
+Tests can skip the sockets and pass ``Hub`` a MockTransport instead.
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import random
+import time
+import types
+from urllib.parse import urlsplit
+from urllib.request import parse_http_list, parse_keqv_list
+
+from aiohttp import web
+
+from _loader import load_myenergi
+
+logger = logging.getLogger(__name__)
+
+REALM = 'MyEnergi Telemetry'
+FIRST_HUB_SERIAL = 10000001
+
+
+def _md5(data):
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+class MockDevice:
+    """A device whose readings drift a little every time it is read."""
+
+    def __init__(self, serial, rng):
+        self.serial = serial
+        self.rng = rng
+        self.generators = [('Grid', rng.uniform(-2000, 2000)),
+                           ('Solar', rng.uniform(0, 4000))]
+
+    def _step(self):
+        self.generators = [
+            (name, power + self.rng.uniform(-50, 50))
+            for name, power in self.generators
+        ]
+
+    def to_json(self, now):
+        self._step()
+        data = {
+            'sno': self.serial,
+            'dat': now.strftime('%d-%m-%Y'),
+            'tim': now.strftime('%H:%M:%S'),
+        }
+        for n in range(1, 4):
+            if n <= len(self.generators):
+                name, power = self.generators[n - 1]
+                data['ectt{}'.format(n)] = name
+                data['ectp{}'.format(n)] = int(power)
+            else:
+                data['ectt{}'.format(n)] = 'None'
+                data['ectp{}'.format(n)] = 0
+        return data
+
+
+class MockHarvi(MockDevice):
+    pass
+
+
+class MockZappi(MockDevice):
+
+    def __init__(self, serial, rng):
+        super().__init__(serial, rng)
+        self.mode = 2
+        self.plugged_in = rng.random() < 0.5
+        self.command_done_at = 0
+
+    def set_mode(self, mode, command_delay):
+        if mode:
+            self.mode = mode
+        self.command_done_at = time.monotonic() + command_delay
+
+    def to_json(self, now):
+        data = super().to_json(now)
+        charging = self.plugged_in and self.mode == 1
+        data.update({
+            'frq': round(self.rng.uniform(49.9, 50.1), 2),
+            'pha': 1,
+            'sta': 3 if charging else 1,
+            'pst': 'C2' if charging else ('B1' if self.plugged_in else 'A'),
+            'vol': int(self.rng.uniform(2350, 2450)),
+            'div': int(self.rng.uniform(6000, 7200)) if charging else 0,
+            'pri': 1,
+            'cmt': 1 if time.monotonic() < self.command_done_at else 254,
+            'zmo': self.mode,
+            'tbk': 0,
+            'sbk': 0,
+            'che': 0,
+            'mgl': 50,
+            'sbh': 0,
+            'sbm': 0,
+        })
+        return data
+
+
+class MockHub:
+
+    def __init__(self, serial, password, zappis, harvis, rng):
+        self.serial = serial
+        self.password = password
+        base = (serial % 1000000) * 100
+        self.zappis = {
+            z.serial: z for z in (
+                MockZappi(base + 10 + n, rng) for n in range(zappis))}
+        self.harvis = {
+            h.serial: h for h in (
+                MockHarvi(base + 50 + n, rng) for n in range(harvis))}
+
+
+class MockDirector:
+    """The director and a single ASN server, on two local ports."""
+
+    def __init__(self, hubs=1, zappis=1, harvis=1, password='password',
+                 latency=0, latency_jitter=0, error_rate=0, command_delay=2,
+                 nonce_lifetime=300, host='127.0.0.1', port=0, asn_port=0,
+                 seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.command_delay = command_delay
+        self.nonce_lifetime = nonce_lifetime
+        self.host = host
+        self.port = port
+        self.asn_port = asn_port
+        self.rng = random.Random(seed)
+        self.hubs = {
+            serial: MockHub(serial, password, zappis, harvis, self.rng)
+            for serial in range(FIRST_HUB_SERIAL, FIRST_HUB_SERIAL + hubs)
+        }
+        self.counts = {'requests': 0, 'challenges': 0, 'redirects': 0,
+                       'errors': 0}
+        self._nonce = None
+        self._nonce_issued = 0
+        self._runners = []
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    @property
+    def asn(self):
+        return '{}:{}'.format(self.host, self.asn_port)
+
+    def _current_nonce(self):
+        if self._nonce is None or time.monotonic() - self._nonce_issued > self.nonce_lifetime:
+            self._nonce = os.urandom(16).hex()
+            self._nonce_issued = time.monotonic()
+        return self._nonce
+
+    def _challenge(self, stale=False):
+        self.counts['challenges'] += 1
+        header = 'Digest realm="{}", qop="auth", nonce="{}", opaque="{}"'.format(
+            REALM, self._current_nonce(), _md5(REALM))
+        if stale:
+            header += ', stale=true'
+        return web.Response(status=401, headers={'WWW-Authenticate': header})
+
+    def _authenticate(self, request):
+        """Return the hub for a valid Authorization header, or a 401."""
+        header = request.headers.get('Authorization', '')
+        if not header.lower().startswith('digest '):
+            return self._challenge()
+        fields = parse_keqv_list(parse_http_list(header[7:]))
+        try:
+            hub = self.hubs[int(fields['username'])]
+        except (KeyError, ValueError):
+            return self._challenge()
+        ha1 = _md5('{}:{}:{}'.format(hub.serial, REALM, hub.password))
+        ha2 = _md5('{}:{}'.format(request.method, fields.get('uri')))
+        expected = _md5(':'.join([
+            ha1, fields.get('nonce', ''), fields.get('nc', ''),
+            fields.get('cnonce', ''), fields.get('qop', ''), ha2]))
+        if fields.get('response') != expected or fields.get('uri') != request.path_qs:
+            return self._challenge()
+        if fields['nonce'] != self._current_nonce():
+            return self._challenge(stale=True)
+        return hub
+
+    async def _delay(self):
+        delay = self.latency + self.rng.uniform(0, self.latency_jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def _handle_director(self, request):
+        self.counts['requests'] += 1
+        await self._delay()
+        hub = self._authenticate(request)
+        if isinstance(hub, web.Response):
+            return hub
+        self.counts['redirects'] += 1
+        return web.Response(status=401, headers={'x_myenergi-asn': self.asn})
+
+    async def _handle_asn(self, request):
+        self.counts['requests'] += 1
+        await self._delay()
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.counts['errors'] += 1
+            return web.Response(status=500)
+        hub = self._authenticate(request)
+        if isinstance(hub, web.Response):
+            return hub
+        path = request.match_info['m']
+        for m, handler in self._endpoints:
+            if path.startswith(m + '-'):
+                return handler(self, hub, path[len(m) + 1:], hourly=(m == 'jdayhour'))
+        raise web.HTTPNotFound()
+
+    def _jstatus(self, hub, args, **kwargs):
+        now = datetime.datetime.utcnow()
+        zappis = [z.to_json(now) for z in hub.zappis.values()]
+        harvis = [h.to_json(now) for h in hub.harvis.values()]
+        if args == '*':
+            return web.json_response([
+                {'eddi': []}, {'zappi': zappis}, {'harvi': harvis},
+                {'asn': self.asn, 'fwv': '3401S3.077'}])
+        if args == 'Z':
+            return web.json_response({'zappi': zappis})
+        if args == 'H':
+            return web.json_response({'harvi': harvis})
+        if args == 'E':
+            return web.json_response({'eddi': []})
+        if args[:1] == 'Z' and args[1:].isdigit() and int(args[1:]) in hub.zappis:
+            return web.json_response(
+                {'zappi': [hub.zappis[int(args[1:])].to_json(now)]})
+        raise web.HTTPNotFound()
+
+    def _find_zappi(self, hub, name):
+        if name[:1] != 'Z' or not name[1:].isdigit() or int(name[1:]) not in hub.zappis:
+            raise web.HTTPNotFound()
+        return hub.zappis[int(name[1:])]
+
+    def _zappi_mode(self, hub, args, **kwargs):
+        parts = args.split('-')
+        if len(parts) != 5:
+            raise web.HTTPBadRequest()
+        zappi = self._find_zappi(hub, parts[0])
+        zappi.set_mode(int(parts[1]), self.command_delay)
+        return web.json_response({'status': 0, 'statustext': ''})
+
+    def _boost_time(self, hub, args, **kwargs):
+        self._find_zappi(hub, args)
+        return web.json_response({'boost_times': [
+            {'bdd': '01111111', 'bdh': 0, 'bdm': 0, 'bsh': 0, 'bsm': 0,
+             'slt': slot}
+            for slot in (11, 12, 13, 14)
+        ]})
+
+    def _jday(self, hub, args, hourly=False):
+        name, _, date = args.partition('-')
+        device = self._find_zappi(hub, name)
+        try:
+            day = datetime.date.fromisoformat(date)
+        except ValueError:
+            raise web.HTTPBadRequest()
+        records = []
+        for i in range(24 if hourly else 1440):
+            hour, minute = (i, 0) if hourly else divmod(i, 60)
+            record = {'yr': day.year, 'mon': day.month, 'dom': day.day,
+                      'dow': day.strftime('%a')}
+            # Zero fields are left out, like the real thing
+            if hour:
+                record['hr'] = hour
+            if minute:
+                record['min'] = minute
+            scale = 60 if hourly else 1
+            record['imp'] = int(self.rng.uniform(0, 60000) * scale)
+            if 9 <= hour < 17:
+                record['gep'] = int(self.rng.uniform(0, 200000) * scale)
+            records.append(record)
+        return web.json_response({'U{}'.format(device.serial): records})
+
+    _endpoints = (
+        ('jstatus', _jstatus),
+        ('zappi-mode', _zappi_mode),
+        ('boost-time', _boost_time),
+        ('jdayhour', _jday),
+        ('jday', _jday),
+    )
+
+    async def _start_site(self, handler, port):
+        app = web.Application()
+        app.router.add_get('/cgi-{m}', handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, port)
+        await site.start()
+        self._runners.append(runner)
+        return runner.addresses[0][1]
+
+    async def async_start(self):
+        self.port = await self._start_site(self._handle_director, self.port)
+        self.asn_port = await self._start_site(self._handle_asn, self.asn_port)
+        logger.info('Mock director on %s, ASN %s, %s hubs', self.url, self.asn,
+                    len(self.hubs))
+
+    async def async_stop(self):
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners = []
+
+
+class MockTransport:
+    """A myenergi transport that hands requests straight to a MockDirector's
+    handlers, without opening any sockets.
+
+    Point hubs at ``director.url``; ``port`` and ``asn_port`` only need to
+    differ, as nothing listens on them.
+    """
+
+    def __init__(self, director):
+        self.director = director
+        self._response = load_myenergi().Response
+
+    async def async_send(self, hub, request, parser=None):
+        Response = self._response
+        url = urlsplit(request.url)
+        path_qs = url.path + ('?' + url.query if url.query else '')
+        fake = types.SimpleNamespace(
+            method='GET', path_qs=path_qs, headers=request.headers,
+            match_info={'m': url.path[len('/cgi-'):]})
+        if request.host == self.director.asn:
+            handler = self.director._handle_asn
+        else:
+            handler = self.director._handle_director
+        try:
+            resp = await handler(fake)
+        except web.HTTPException as e:
+            return Response(e.status, {}, b'', 0)
+        body = resp.body or b''
+        if parser is not None and resp.status < 300:
+            parser.feed(body)
+            return Response(resp.status, resp.headers, None, len(body))
+        return Response(resp.status, resp.headers, body, len(body))
+
+
+async def async_main(args):
+    director = MockDirector(
+        hubs=args.hubs, zappis=args.zappis, harvis=args.harvis,
+        password=args.password, latency=args.latency,
+        latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+        host=args.host, port=args.port, asn_port=args.asn_port,
+        seed=args.seed)
+    await director.async_start()
+    print('Director: {}  ASN: {}  hubs: {}-{}'.format(
+        director.url, director.asn, FIRST_HUB_SERIAL,
+        FIRST_HUB_SERIAL + args.hubs - 1), flush=True)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await director.async_stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hubs', type=int, default=1)
+    parser.add_argument('--zappis', type=int, default=1, help='per hub')
+    parser.add_argument('--harvis', type=int, default=1, help='per hub')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--latency', type=float, default=0, help='seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0, help='seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of ASN requests answered with a 500')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--asn-port', type=int, default=8081)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(async_main(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
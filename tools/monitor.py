@@ -0,0 +1,12 @@
+"""Stream readings from MyEnergi hubs to stdout as NDJSON or CSV.
+
+    python tools/monitor.py 12345678:password 23456789:password --format csv
+
+See ``--help`` for the options. This is ``myenergi.main``, run from here
+rather than by running myenergi.py directly; see _loader.py for why.
+"""
+from _loader import load_myenergi
+
+
+if __name__ == '__main__':
+    load_myenergi().main()
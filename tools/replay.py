@@ -0,0 +1,155 @@
+"""Record a hub's responses from the director, and replay them offline.
+
+Record every poll of one or more real hubs to a file::
+
+    python tools/replay.py record fleet.ndjson 12345678:password 23456789:password
+
+then replay it without credentials or network access, as fast as it will
+go or faster than real time, optionally under the profiler::
+
+    python tools/replay.py replay fleet.ndjson --speed 1000 --profile
+
+Replaying runs each hub's recorded polls through a Fleet and the same
+parsing, energy meter and poll scheduler code as the Home Assistant
+component. Circuit breakers are off while replaying, as requests they
+held back while recording were never made.
+"""
+import argparse
+import asyncio
+import cProfile
+import logging
+import pstats
+import sys
+import time
+
+from _loader import load_myenergi
+
+myenergi = load_myenergi()
+
+
+async def async_record(args):
+    transport = myenergi.RecordingTransport(args.path)
+    fleet = myenergi.Fleet(interval=args.interval, director=args.director,
+                           transport=transport)
+    for serial, password in args.hubs:
+        fleet.add_hub(serial, password)
+    polls = 0
+    try:
+        while args.count is None or polls < args.count:
+            await fleet.async_poll_all()
+            for serial, e in fleet.errors.items():
+                print('Poll of {} failed: {}'.format(serial, e), file=sys.stderr)
+            polls += 1
+            print('\rRecorded {} polls'.format(polls), end='', file=sys.stderr, flush=True)
+            await asyncio.sleep(args.interval)
+    finally:
+        print(file=sys.stderr)
+        await fleet.async_stop()
+        transport.close()
+
+
+async def async_replay(args):
+    transport = myenergi.ReplayTransport(args.path, speed=args.speed)
+    metrics = myenergi.Metrics()
+    meters = {}
+    schedulers = {}
+    failed = [0]
+
+    async def on_poll(hub, devices):
+        all_devices = devices[myenergi.Zappi.device_map_key] + \
+            devices[myenergi.Harvi.device_map_key]
+        meters[hub.serial].add_devices(all_devices)
+        schedulers[hub.serial].next_interval(all_devices)
+
+    # Recordings from before hubs were recorded are for one hub
+    serials = transport.serials or [args.serial]
+    # Every hub at once, so that replaying in real time isn't held up
+    fleet = myenergi.Fleet(max_concurrency=len(serials), metrics=metrics,
+                           on_poll=on_poll, transport=transport)
+    fleet.failure_threshold = None
+    for serial in serials:
+        fleet.add_hub(serial, '')
+        meters[serial] = myenergi.EnergyMeter()
+        schedulers[serial] = myenergi.PollScheduler()
+
+    async def replay_hub(hub):
+        polls = 0
+        while True:
+            try:
+                await fleet.async_poll_hub(hub)
+            except myenergi.ReplayFinished:
+                return polls
+            if hub.serial in fleet.errors:
+                failed[0] += 1
+                print('Recorded poll of {} failed: {}'.format(
+                    hub, fleet.errors[hub.serial]), file=sys.stderr)
+            polls += 1
+
+    try:
+        polls = sum(await asyncio.gather(*[
+            replay_hub(hub) for hub in fleet.hubs.values()]))
+    finally:
+        await fleet.async_stop()
+    for meter in meters.values():
+        meter.flush()
+    return polls, failed[0], meters, metrics
+
+
+def replay(args):
+    profile = cProfile.Profile() if args.profile else None
+    started = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    polls, failed, meters, metrics = asyncio.run(async_replay(args))
+    if profile is not None:
+        profile.disable()
+    elapsed = time.perf_counter() - started
+
+    print('Replayed {} polls of {} hubs in {:.2f} seconds, {} failed'.format(
+        polls, len(meters), elapsed, failed))
+    for serial, meter in meters.items():
+        print('Energy for {} (kWh): {}'.format(serial, ', '.join(
+            '{} {:.3f}'.format(k, v) for k, v in meter.totals.items())))
+    for labels, histogram in sorted(metrics.histograms['myenergi_parse_seconds'].items()):
+        print('Parsed {} {} readings, {:.1f} us each'.format(
+            histogram.count, dict(labels)['device'],
+            histogram.sum / histogram.count * 1e6))
+    if profile is not None:
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(args.profile_lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='record live hubs')
+    record_parser.add_argument('path')
+    record_parser.add_argument('hubs', nargs='+', type=myenergi._hub_arg,
+                               metavar='SERIAL:PASSWORD')
+    record_parser.add_argument('--interval', type=float, default=10, help='seconds')
+    record_parser.add_argument('--count', type=int, help='stop after this many polls')
+    record_parser.add_argument('--director', help='director URL, e.g. a mock director')
+
+    replay_parser = subparsers.add_parser('replay', help='replay a recording')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--serial', default='replay',
+                               help='hub serial for recordings without one')
+    replay_parser.add_argument('--speed', type=float,
+                               help='replay at this multiple of real time, '
+                                    'instead of as fast as possible')
+    replay_parser.add_argument('--profile', action='store_true')
+    replay_parser.add_argument('--profile-lines', type=int, default=25)
+
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.command == 'record':
+        try:
+            asyncio.run(async_record(args))
+        except KeyboardInterrupt:
+            pass
+    else:
+        replay(args)
+
+
+if __name__ == '__main__':
+    main()